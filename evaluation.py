@@ -50,90 +50,104 @@ def application(name, slo, nodes, target1components, deploy, teardown, traces_an
     trace = warmup + trace
     dump_trace(trace, 'rps.txt')
 
-    # see section A.7 in the paper for the warmup process
-    for i in range(6):
-        path = f'data/{name}/autothrottle-warmup/a{i + 1}'
-        if benchmark(
-            output_dir=path,
-            namespace=namespace,
-            locustfile=locustfile,
-            url=url,
-            nodes=nodes,
-            deploy=deploy,
-            teardown=teardown,
-            scalers={i: {'type': 'captain', 'params': (0.0, initial_limit)} for i in components},
-            tower=ExploreTower(
-                scaler='captain',
-                targets=tower_targets,
-                target1components=target1components,
-                samples=[],
-                warmup=warmup_minutes,
-            ),
-            locust_workers=locust_workers,
-        ):
-            allocation = TimeSeries.zip_with(lambda *args: sum(args), *[v for k, v in load_cpu_limit(path).items()]) \
-                .downsample_time_weighted_average(60).slice(warmup_seconds + 30, float('inf')).average()
-            request_latency = load_request_latency(path).slice(warmup_seconds, float('inf'))
-            p99_latency = request_latency.percentage(99)
-            average_rps = len(request_latency) / 3600
-            log = {
-                'time': datetime.datetime.utcnow().isoformat() + 'Z',
-                'path': path,
-                'application': name,
-                'trace': 'diurnal-2',
-                'scaler': 'autothrottle',
-                'warmup': f'a{i + 1}',
-                'allocation': allocation,
-                'p99_latency': p99_latency,
-                'average_rps': average_rps,
-            }
-            with open('log.json', 'a') as f:
-                f.write(json.dumps(log) + '\n')
-            send_notification(f'{name} warmup {i + 1} / 12 finished')
-        samples += load_samples(path)
-    for i in range(6):
-        path = f'data/{name}/autothrottle-warmup/b{i + 1}'
-        if benchmark(
-            output_dir=path,
-            namespace=namespace,
-            locustfile=locustfile,
-            url=url,
-            nodes=nodes,
-            deploy=deploy,
-            teardown=teardown,
-            scalers={i: {'type': 'captain', 'params': (0.0, initial_limit)} for i in components},
-            tower=VwTower(
-                scaler='captain',
-                targets=tower_targets,
-                target1components=target1components,
-                slo=slo,
-                samples=samples,
-                explore=0.5,
-                drop_samples=warmup_minutes,
-                aggregate_samples=aggregate_samples,
-            ),
-            locust_workers=locust_workers,
-        ):
-            allocation = TimeSeries.zip_with(lambda *args: sum(args), *[v for k, v in load_cpu_limit(path).items()]) \
-                .downsample_time_weighted_average(60).slice(warmup_seconds + 30, float('inf')).average()
-            request_latency = load_request_latency(path).slice(warmup_seconds, float('inf'))
-            p99_latency = request_latency.percentage(99)
-            average_rps = len(request_latency) / 3600
-            log = {
-                'time': datetime.datetime.utcnow().isoformat() + 'Z',
-                'path': path,
-                'application': name,
-                'trace': 'diurnal-2',
-                'scaler': 'autothrottle',
-                'warmup': f'b{i + 1}',
-                'allocation': allocation,
-                'p99_latency': p99_latency,
-                'average_rps': average_rps,
-            }
-            with open('log.json', 'a') as f:
-                f.write(json.dumps(log) + '\n')
-            send_notification(f'{name} warmup {i + 7} / 12 finished')
-        samples += load_samples(path)[warmup_minutes:]
+    # the warmup process only runs once for each application, SLO, target1components, and aggregate_samples
+    # its samples and the model trained on them are saved as a checkpoint, and later sessions start from it
+    checkpoint = tower_checkpoint_path('checkpoints', name, slo, target1components, tower_targets, aggregate_samples)
+    samples = load_tower_checkpoint(checkpoint)
+    if samples is None:
+        samples = []
+        # see section A.7 in the paper for the warmup process
+        for i in range(6):
+            path = f'data/{name}/autothrottle-warmup/a{i + 1}'
+            if benchmark(
+                output_dir=path,
+                namespace=namespace,
+                locustfile=locustfile,
+                url=url,
+                nodes=nodes,
+                deploy=deploy,
+                teardown=teardown,
+                scalers={i: {'type': 'captain', 'params': (0.0, initial_limit)} for i in components},
+                tower=ExploreTower(
+                    scaler='captain',
+                    targets=tower_targets,
+                    target1components=target1components,
+                    samples=[],
+                    warmup=warmup_minutes,
+                ),
+                locust_workers=locust_workers,
+            ):
+                allocation = TimeSeries.zip_with(lambda *args: sum(args), *[v for k, v in load_cpu_limit(path).items()]) \
+                    .downsample_time_weighted_average(60).slice(warmup_seconds + 30, float('inf')).average()
+                request_latency = load_request_latency(path).slice(warmup_seconds, float('inf'))
+                p99_latency = request_latency.percentage(99)
+                average_rps = len(request_latency) / 3600
+                log = {
+                    'time': datetime.datetime.utcnow().isoformat() + 'Z',
+                    'path': path,
+                    'application': name,
+                    'trace': 'diurnal-2',
+                    'scaler': 'autothrottle',
+                    'warmup': f'a{i + 1}',
+                    'allocation': allocation,
+                    'p99_latency': p99_latency,
+                    'average_rps': average_rps,
+                }
+                with open('log.json', 'a') as f:
+                    f.write(json.dumps(log) + '\n')
+                send_notification(f'{name} warmup {i + 1} / 12 finished')
+            samples += load_samples(path)
+        for i in range(6):
+            path = f'data/{name}/autothrottle-warmup/b{i + 1}'
+            if benchmark(
+                output_dir=path,
+                namespace=namespace,
+                locustfile=locustfile,
+                url=url,
+                nodes=nodes,
+                deploy=deploy,
+                teardown=teardown,
+                scalers={i: {'type': 'captain', 'params': (0.0, initial_limit)} for i in components},
+                tower=VwTower(
+                    scaler='captain',
+                    targets=tower_targets,
+                    target1components=target1components,
+                    slo=slo,
+                    samples=samples,
+                    explore=0.5,
+                    drop_samples=warmup_minutes,
+                    aggregate_samples=aggregate_samples,
+                ),
+                locust_workers=locust_workers,
+            ):
+                allocation = TimeSeries.zip_with(lambda *args: sum(args), *[v for k, v in load_cpu_limit(path).items()]) \
+                    .downsample_time_weighted_average(60).slice(warmup_seconds + 30, float('inf')).average()
+                request_latency = load_request_latency(path).slice(warmup_seconds, float('inf'))
+                p99_latency = request_latency.percentage(99)
+                average_rps = len(request_latency) / 3600
+                log = {
+                    'time': datetime.datetime.utcnow().isoformat() + 'Z',
+                    'path': path,
+                    'application': name,
+                    'trace': 'diurnal-2',
+                    'scaler': 'autothrottle',
+                    'warmup': f'b{i + 1}',
+                    'allocation': allocation,
+                    'p99_latency': p99_latency,
+                    'average_rps': average_rps,
+                }
+                with open('log.json', 'a') as f:
+                    f.write(json.dumps(log) + '\n')
+                send_notification(f'{name} warmup {i + 7} / 12 finished')
+            samples += load_samples(path)[warmup_minutes:]
+        VwTower(
+            scaler='captain',
+            targets=tower_targets,
+            target1components=target1components,
+            slo=slo,
+            samples=samples,
+            aggregate_samples=aggregate_samples,
+        ).save(checkpoint)
 
     for trace_name, scaler_targets in traces_and_targets.items():
         # all our locustfiles are designed to read each second's RPS from rps.txt
@@ -176,8 +190,11 @@ def application(name, slo, nodes, target1components, deploy, teardown, traces_an
                 explore=0.0,
                 drop_samples=warmup_minutes,
                 aggregate_samples=aggregate_samples,
+                model=checkpoint/'model.vw',
             ),
             locust_workers=locust_workers,
+            # only used by worker daemons started with --budget, when the limits of a node do not fit
+            priorities={i: 2 for i in target1components},
         ):
             allocation = TimeSeries.zip_with(lambda *args: sum(args), *[v for k, v in load_cpu_limit(path).items()]) \
                 .downsample_time_weighted_average(60).slice(warmup_seconds + 30, float('inf')).average()
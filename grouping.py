@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import pathlib
+
+import numpy
+
+from utils import load_cpu_usage, load_stats
+
+
+# the average of the (t, v) samples in each second from start, as an array with nan for seconds without samples
+def per_second(series, start, length):
+    if not len(series):
+        return numpy.full(length, numpy.nan)
+    t, v = (numpy.array(i, dtype=float) for i in series.columns())
+    i = numpy.floor(t - start).astype(int)
+    # negative rates come from counters that started over when a pod restarted
+    valid = (i >= 0) & (i < length) & (v >= 0)
+    total = numpy.bincount(i[valid], v[valid], length)
+    count = numpy.bincount(i[valid], None, length)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+# the CPU usage of each component and the RPS in each second of a benchmark after start seconds,
+# as (components, usage array with a row for each component, rps array)
+def load_run(path, start=0):
+    usage = load_cpu_usage(path)
+    rps = load_stats(path, 'rps')['_tower']
+    length = max(0, int(rps.data[-1][0] - start) + 1) if len(rps) else 0
+    components = sorted(usage)
+    return components, numpy.array([per_second(usage[k], start, length) for k in components]).reshape(-1, length), per_second(rps, start, length)
+
+
+def load_run_job(args):
+    return load_run(*args)
+
+
+# per-component features over the seconds of all runs, seconds in which a component has no samples are left out
+# mean and std are in cores, burstiness is the 99th percentile over the mean,
+# and rps_correlation is the correlation of the usage with the RPS
+def usage_features(runs):
+    components = sorted(set().union(*(set(i[0]) for i in runs)))
+    index = {k: i for i, k in enumerate(components)}
+    columns = []
+    rps_columns = []
+    for run_components, usage, rps in runs:
+        column = numpy.full((len(components), usage.shape[1]), numpy.nan)
+        column[[index[k] for k in run_components]] = usage
+        columns.append(column)
+        rps_columns.append(rps)
+    usage = numpy.concatenate(columns, axis=1)
+    rps = numpy.broadcast_to(numpy.concatenate(rps_columns), usage.shape)
+
+    valid = ~numpy.isnan(usage)
+    count = valid.sum(axis=1)
+    mean = numpy.where(valid, usage, 0).sum(axis=1) / count
+    std = numpy.sqrt(numpy.where(valid, (usage - mean[:, None]) ** 2, 0).sum(axis=1) / count)
+    p99 = numpy.nanpercentile(usage, 99, axis=1)
+    both = valid & ~numpy.isnan(rps)
+    both_count = both.sum(axis=1)
+    usage_mean = numpy.where(both, usage, 0).sum(axis=1) / both_count
+    rps_mean = numpy.where(both, rps, 0).sum(axis=1) / both_count
+    usage_centered = numpy.where(both, usage - usage_mean[:, None], 0)
+    rps_centered = numpy.where(both, rps - rps_mean[:, None], 0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        correlation = (usage_centered * rps_centered).sum(axis=1) / numpy.sqrt((usage_centered ** 2).sum(axis=1) * (rps_centered ** 2).sum(axis=1))
+        burstiness = p99 / mean
+    return components, {
+        'mean': mean,
+        'std': std,
+        'burstiness': numpy.nan_to_num(burstiness, nan=1),
+        'rps_correlation': numpy.nan_to_num(correlation),
+    }
+
+
+# k-means of the rows of x, the best of restarts runs from k-means++ seeds, returns the cluster of each row
+def kmeans(x, k, restarts=10, iterations=100, seed=0):
+    rng = numpy.random.default_rng(seed)
+    k = min(k, len(x))
+    best = None
+    for _ in range(restarts):
+        centers = x[[rng.integers(len(x))]]
+        while len(centers) < k:
+            distance = ((x[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+            if not distance.sum():
+                break
+            centers = numpy.concatenate([centers, x[[rng.choice(len(x), p=distance / distance.sum())]]])
+        for _ in range(iterations):
+            labels = ((x[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+            new_centers = numpy.array([x[labels == i].mean(axis=0) if (labels == i).any() else centers[i] for i in range(len(centers))])
+            if numpy.allclose(new_centers, centers):
+                break
+            centers = new_centers
+        inertia = ((x - centers[labels]) ** 2).sum()
+        if best is None or inertia < best[0]:
+            best = (inertia, labels)
+    return best[1]
+
+
+# groups the components of the benchmarks in paths into k groups by their usage features,
+# each feature is standardized, and mean and std are taken in log scale since they span orders of magnitude
+# returns (groups, features), groups are lists of components, the group with the highest total usage first
+def group_components(paths, k, start=0, features=('mean', 'std', 'burstiness', 'rps_correlation'), max_workers=None, seed=0):
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        runs = list(executor.map(load_run_job, [(path, start) for path in paths]))
+    components, values = usage_features(runs)
+    x = []
+    for name in features:
+        v = values[name]
+        if name in ('mean', 'std'):
+            v = numpy.log(v + 1e-3)
+        v = numpy.nan_to_num(v)
+        x.append((v - v.mean()) / (v.std() or 1))
+    labels = kmeans(numpy.array(x).T, k, seed=seed)
+    groups = [[components[i] for i in numpy.flatnonzero(labels == label)] for label in numpy.unique(labels)]
+    index = {k: i for i, k in enumerate(components)}
+    groups.sort(key=lambda group: -sum(values['mean'][index[i]] for i in group))
+    return groups, {k: {name: float(v[i]) for name, v in values.items()} for i, k in enumerate(components)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='group components by the CPU usage recorded in benchmarks, for target1components or the groups of FactoredVwTower')
+    parser.add_argument('paths', nargs='+', help='benchmark directories, for example of const scalers with DummyTower')
+    parser.add_argument('-k', type=int, default=2, help='number of groups')
+    parser.add_argument('--start', type=float, default=0, help='seconds to skip at the start of each benchmark, like its warmup')
+    parser.add_argument('--features', nargs='+', choices=['mean', 'std', 'burstiness', 'rps_correlation'], default=['mean', 'std', 'burstiness', 'rps_correlation'])
+    parser.add_argument('--workers', type=int, help='number of processes to load benchmarks with, defaults to the number of CPUs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the groups and the features of each component to this JSON file')
+    args = parser.parse_args()
+
+    groups, features = group_components(args.paths, args.k, args.start, args.features, args.workers, args.seed)
+    print('component', *next(iter(features.values())), sep='\t')
+    for i, group in enumerate(groups):
+        print(f'# group {i}')
+        for k in group:
+            print(k, *(f'{v:.3f}' for v in features[k].values()), sep='\t')
+    if len(groups) == 2:
+        print('target1components =', json.dumps(groups[0]))
+    print('groups =', json.dumps(groups))
+    if args.output is not None:
+        pathlib.Path(args.output).write_text(json.dumps({'groups': groups, 'features': features}))
+
+
+if __name__ == '__main__':
+    main()
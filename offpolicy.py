@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import itertools
+import json
+import pathlib
+
+import numpy
+
+from utils import VwTower, load_samples, load_tower_checkpoint
+
+
+# the samples of benchmark directories and VwTower checkpoints (see VwTower.save), in the order given
+def load_all_samples(paths):
+    samples = []
+    for path in paths:
+        path = pathlib.Path(path)
+        if (path/'samples.json.xz').exists():
+            samples += load_tower_checkpoint(path)
+        else:
+            samples += load_samples(path)
+    return samples
+
+
+# the towers compared here are two-dimensional VwTowers (target1components and the others), so every action
+# must be a single index into the len(targets) ** 2 pairs of targets
+# samples of FactoredExploreTower and FactoredVwTower have one action per group and cannot be scored this way
+def check_samples(samples, targets):
+    actions = len(targets) ** 2
+    for sample in samples:
+        action = sample[1]
+        if isinstance(action, (list, tuple)):
+            raise ValueError(f'sample {sample} has one action per group, offpolicy.py only compares VwTower settings on VwTower samples')
+        if not 0 <= action < actions:
+            raise ValueError(f'sample {sample} has an action outside the {actions} pairs of {len(targets)} targets')
+
+
+# estimates the average cost (see VwTower.cost, lower is better) a VwTower trained with config would have had
+# on the recorded samples, which were taken by other towers with the recorded action_p
+# the samples are split into folds in time order, and each fold is scored by a tower trained on the other folds
+# ips weighs the recorded costs by how much more (or less) likely the tower is to take the recorded action
+# dr starts from the aggregated costs of the training folds (see VwTower.aggregate) for every action,
+# and corrects them the same way, so it is less noisy when few recorded actions are the ones the tower would take
+# costs are normalized against all samples, so every config and fold uses the same scale
+def evaluate(samples, config, slo, targets, explore, folds, seed):
+    numpy.random.seed(seed)
+    actions = len(targets) ** 2
+    ips = 0
+    dr = 0
+    count = 0
+    for k in range(folds):
+        start = k * len(samples) // folds
+        end = (k + 1) * len(samples) // folds
+        train_samples = samples[:start] + samples[end:]
+        test_samples = samples[start:end]
+        if not train_samples or not test_samples:
+            continue
+        tower = VwTower('captain', targets, set(), slo, samples=samples, explore=explore, aggregate_samples=config['aggregate_samples'])
+        tower.learning_rate = config['learning_rate']
+        tower.hidden_units = config['hidden_units']
+        tower.train_examples = config['train_examples']
+        tower.aggregation = config['aggregation']
+
+        aggregated_samples = tower.aggregate(train_samples)
+        estimates = {(rps, action): cost for rps, action, _, cost in aggregated_samples}
+        default_estimate = sum(i[3] for i in aggregated_samples) / len(aggregated_samples)
+        vw = tower.train(train_samples)
+        table = tower.policy(vw, tower.max_rps)
+        vw.finish()
+
+        for rps, action, action_p, latency, allocation in test_samples:
+            if action_p <= 0:
+                continue
+            i = round(rps / tower.aggregate_samples)
+            distribution = table['distribution'][i]
+            # the same choice as VwTower.__call__
+            if max(distribution) == 1:
+                distribution = tower.explore_distribution(distribution.index(max(distribution)))
+            cost = tower.cost(latency, allocation)
+            estimate = [estimates.get((i * tower.aggregate_samples, a), default_estimate) for a in range(actions)]
+            weight = distribution[action] / action_p
+            ips += weight * cost
+            dr += sum(p * e for p, e in zip(distribution, estimate)) + weight * (cost - estimate[action])
+            count += 1
+    return {
+        'ips': ips / count if count else None,
+        'dr': dr / count if count else None,
+        'count': count,
+    }
+
+
+def evaluate_job(args):
+    config, samples, slo, targets, explore, folds, seed = args
+    return config, evaluate(samples, config, slo, targets, explore, folds, seed)
+
+
+# evaluates every combination of the candidate values in parallel, returns [(config, result)] best (lowest dr) first
+def sweep(samples, slo, targets, candidates, explore=0.1, folds=5, seed=0, max_workers=None):
+    check_samples(samples, targets)
+    keys = list(candidates)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(candidates[k] for k in keys))]
+    jobs = [(config, samples, slo, targets, explore, folds, seed) for config in configs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        results = list(executor.map(evaluate_job, jobs))
+    return sorted(results, key=lambda i: float('inf') if i[1]['dr'] is None else i[1]['dr'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare VwTower settings on the samples of recorded benchmarks, without running them')
+    parser.add_argument('paths', nargs='+', help='benchmark directories or tower checkpoints to take the samples from')
+    parser.add_argument('--slo', type=float, required=True, help='P99 latency SLO, in the unit of the recorded p99_latency')
+    parser.add_argument('--targets', type=float, nargs='+', default=[0.0, 0.02, 0.04, 0.06, 0.1, 0.15, 0.2, 0.25, 0.3])
+    parser.add_argument('--explore', type=float, default=0.1)
+    parser.add_argument('--learning-rates', type=float, nargs='+', default=[VwTower.learning_rate])
+    parser.add_argument('--hidden-units', type=int, nargs='+', default=[VwTower.hidden_units])
+    parser.add_argument('--train-examples', type=int, nargs='+', default=[VwTower.train_examples])
+    parser.add_argument('--aggregations', choices=['median', 'mean'], nargs='+', default=[VwTower.aggregation])
+    parser.add_argument('--aggregate-samples', type=int, nargs='+', default=[20])
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='number of processes, defaults to the number of CPUs')
+    parser.add_argument('--output', help='write all results to this JSON file')
+    args = parser.parse_args()
+
+    samples = load_all_samples(args.paths)
+    try:
+        check_samples(samples, args.targets)
+    except ValueError as e:
+        parser.error(str(e))
+    # what the recorded towers did, for comparison
+    tower = VwTower('captain', args.targets, set(), args.slo, samples=samples)
+    print('recorded cost:', f'{sum(tower.cost(i[3], i[4]) for i in samples) / len(samples):.4f}', 'samples:', len(samples))
+    candidates = {
+        'learning_rate': args.learning_rates,
+        'hidden_units': args.hidden_units,
+        'train_examples': args.train_examples,
+        'aggregation': args.aggregations,
+        'aggregate_samples': args.aggregate_samples,
+    }
+    results = sweep(samples, args.slo, args.targets, candidates, args.explore, args.folds, args.seed, args.workers)
+    print(*candidates, 'ips', 'dr', sep='\t')
+    for config, result in results:
+        if result['dr'] is None:
+            print(*config.values(), None, None, sep='\t')
+        else:
+            print(*config.values(), f'{result["ips"]:.4f}', f'{result["dr"]:.4f}', sep='\t')
+    if args.output is not None:
+        pathlib.Path(args.output).write_text(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import lzma
+import pathlib
+import statistics
+
+from scalers import default_targets, scaler_params, worker_daemon
+
+
+# the recorded samples of each component in stats.json.xz, as (t, cpu_usage, nr_periods, nr_throttled, limit) rows
+# limit is None while the component was unlimited
+def load_component_stats(path, components=None):
+    path = pathlib.Path(path)
+    with lzma.open(path/'stats.json.xz', 'rt') as f:
+        stats = json.load(f)
+    result = {}
+    for component, l in stats.items():
+        if components is not None and component not in components:
+            continue
+        rows = [
+            (t, d['cpu_usage'], d['cpu_stat.nr_periods'], d['cpu_stat.nr_throttled'], d.get('scaler.limit'))
+            for t, d in l
+            if 'cpu_usage' in d and 'cpu_stat.nr_throttled' in d
+        ]
+        if rows:
+            result[component] = rows
+    return result
+
+
+# drives a scaler (see init_scaler in worker-daemon.py) through the recorded samples of one component
+# the recorded usage is taken as the demand, what the component would have used under the replayed limit is
+# min(demand, limit), and the scaler sees counters built from that
+# throttling is estimated per tick: every period when the demand exceeds the replayed limit,
+# otherwise the recorded throttling scaled by how much less (or more) headroom above the demand the replayed limit leaves
+# demand that was itself throttled by the recorded limit is underestimated, so replay benchmarks with generous limits
+# the scaler is stepped at the sampling period of the recording, the median time between its samples
+def replay(rows, scaler):
+    tick = statistics.median([t2 - t1 for (t1, *_), (t2, *_) in zip(rows, rows[1:]) if t2 > t1] or [0.1])
+    scaler = worker_daemon.init_scaler(scaler, round(tick, 3))
+    limits = []
+    allocation = 0
+    duration = 0
+    unmet = 0
+    periods = 0
+    throttled_periods = 0
+    usage = 0
+    nr_periods = 0
+    nr_throttled = 0
+    limit = None
+    last = None
+    for t, recorded_usage, recorded_periods, recorded_throttled, recorded_limit in rows:
+        if last is not None:
+            dt = t - last[0]
+            if dt <= 0:
+                continue
+            demand = (recorded_usage - last[1]) / dt
+            new_periods = recorded_periods - last[2]
+            new_throttled = recorded_throttled - last[3]
+            if limit is None:
+                used = demand
+            elif demand >= limit:
+                used = limit
+                new_throttled = new_periods
+            else:
+                used = demand
+                if recorded_limit is not None and recorded_limit > demand:
+                    new_throttled = min(new_periods, new_throttled * (recorded_limit - demand) / (limit - demand))
+            usage += used * dt
+            nr_periods += new_periods
+            nr_throttled += new_throttled
+            periods += new_periods
+            throttled_periods += new_throttled
+            unmet += (demand - used) * dt
+            if limit is not None:
+                allocation += limit * dt
+                duration += dt
+        last = (t, recorded_usage, recorded_periods, recorded_throttled)
+        new_limit = scaler(t, {
+            'cpu_usage': usage,
+            'cpu_stat.nr_periods': nr_periods,
+            'cpu_stat.nr_throttled': nr_throttled,
+        })
+        if new_limit is not None:
+            new_limit = max(0.01, new_limit)
+        if new_limit != limit:
+            limits.append((t, new_limit))
+        limit = new_limit
+    return {
+        'limits': limits,
+        'allocation': allocation / duration if duration else None,
+        'throttled_ratio': throttled_periods / periods if periods else 0,
+        'unmet': unmet,
+    }
+
+
+def replay_job(args):
+    component, target, rows, scaler = args
+    return component, target, replay(rows, scaler)
+
+
+# replays every component with every target in parallel, returns {target: {component: replay result}}
+def replay_targets(path, scaler_type, targets, initial_limit=32, components=None, max_workers=None):
+    stats = load_component_stats(path, components)
+    jobs = [
+        (component, target, rows, {'type': scaler_type, 'params': scaler_params(scaler_type, target, initial_limit)})
+        for target in targets
+        for component, rows in stats.items()
+    ]
+    results = {target: {} for target in targets}
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        for component, target, result in executor.map(replay_job, jobs, chunksize=max(1, len(jobs) // 64)):
+            results[target][component] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay a scaler over the CPU usage recorded in a benchmark')
+    parser.add_argument('path', help='benchmark directory containing stats.json.xz')
+    parser.add_argument('--scaler', choices=['captain', 'k8s-cpu', 'k8s-cpu-fast', 'const'], default='captain')
+    parser.add_argument('--targets', type=float, nargs='+', help='defaults to the default_targets of the scaler in scalers.py')
+    parser.add_argument('--initial-limit', type=float, default=32)
+    parser.add_argument('--components', nargs='+', help='only replay these components')
+    parser.add_argument('--workers', type=int, help='number of processes, defaults to the number of CPUs')
+    parser.add_argument('--output', help='write all results including the limit series to this JSON file')
+    args = parser.parse_args()
+
+    targets = args.targets or default_targets[args.scaler]
+    results = replay_targets(args.path, args.scaler, targets, args.initial_limit, args.components, args.workers)
+    print('target', 'allocation', 'throttled_ratio', 'unmet', sep='\t')
+    for target, result in results.items():
+        allocation = sum(i['allocation'] or 0 for i in result.values())
+        throttled_ratio = sum(i['throttled_ratio'] for i in result.values()) / len(result) if result else 0
+        unmet = sum(i['unmet'] for i in result.values())
+        print(target, f'{allocation:.3f}', f'{throttled_ratio:.4f}', f'{unmet:.1f}', sep='\t')
+    if args.output is not None:
+        pathlib.Path(args.output).write_text(json.dumps({str(k): v for k, v in results.items()}))
+
+
+if __name__ == '__main__':
+    main()
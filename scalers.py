@@ -0,0 +1,22 @@
+import importlib
+
+# the scalers are the ones the worker daemons run, imported from worker-daemon.py
+# for the tools that drive them offline, like replay.py and simulator.py
+worker_daemon = importlib.import_module('worker-daemon')
+
+# the targets to try for each type of scaler when none are given
+# captain targets a ratio of throttled periods, the k8s scalers a CPU utilization (above 0), and const is a limit in cores
+default_targets = {
+    'captain': [0.0, 0.02, 0.04, 0.06, 0.1, 0.15, 0.2, 0.25, 0.3],
+    'k8s-cpu': [0.5, 0.6, 0.7, 0.8, 0.9],
+    'k8s-cpu-fast': [0.5, 0.6, 0.7, 0.8, 0.9],
+    'const': [0.5, 1, 2, 4, 8],
+}
+
+
+# the params of a scaler of scaler_type with target, see init_scaler in worker-daemon.py
+# the target of a const scaler is its limit, it has no other parameters
+def scaler_params(scaler_type, target, initial_limit):
+    if scaler_type == 'const':
+        return (target,)
+    return (target, initial_limit)
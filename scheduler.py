@@ -0,0 +1,83 @@
+import bisect
+import math
+import time
+
+
+class Histogram:
+    # fixed buckets in seconds, the last bucket counts everything above the last bound
+    bounds = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.count += 1
+        self.sum += v
+        self.max = max(self.max, v)
+
+    def to_dict(self):
+        return {
+            'bounds': list(self.bounds),
+            'counts': self.counts,
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+        }
+
+
+class Ticker:
+    # ticks at absolute deadlines offset + k * period of time.perf_counter(), so sleeping never accumulates drift
+    # when the work of a tick overruns, policy 'skip' continues with the next deadline in the future,
+    # and policy 'catch-up' runs the missed ticks back to back without sleeping
+    # lateness is how long after its deadline a tick woke up, work time is how long the caller took until the next wait()
+    def __init__(self, period, offset=0, policy='skip'):
+        assert period > 0
+        assert policy in ('skip', 'catch-up')
+        self.period = period
+        self.offset = offset
+        self.policy = policy
+        self.k = None
+        self.woke = None
+        self.skipped = 0
+        self.lateness = Histogram()
+        self.work_time = Histogram()
+        self.last_lateness = 0
+        self.last_work_time = 0
+
+    def deadline(self):
+        return self.offset + self.k * self.period
+
+    # sleeps until the next deadline and returns it
+    def wait(self):
+        now = time.perf_counter()
+        if self.woke is not None:
+            self.last_work_time = now - self.woke
+            self.work_time.add(self.last_work_time)
+        if self.k is None:
+            self.k = math.ceil((now - self.offset) / self.period)
+        else:
+            self.k += 1
+            if self.policy == 'skip' and self.deadline() < now:
+                missed = math.ceil((now - self.deadline()) / self.period)
+                self.skipped += missed
+                self.k += missed
+        t = self.deadline()
+        if t > now:
+            time.sleep(t - now)
+        self.woke = time.perf_counter()
+        self.last_lateness = max(0, self.woke - t)
+        self.lateness.add(self.last_lateness)
+        return t
+
+    def to_dict(self):
+        return {
+            'period': self.period,
+            'policy': self.policy,
+            'skipped': self.skipped,
+            'lateness': self.lateness.to_dict(),
+            'work_time': self.work_time.to_dict(),
+        }
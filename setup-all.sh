@@ -17,7 +17,7 @@ for i in {1..5}; do
 done
 
 # upload to master
-rsync -avz evaluation.py flannel.yaml hotel-reservation requirements.txt setup-node.sh social-network traces train-ticket utils.py root@autothrottle-1:
+rsync -avz evaluation.py flannel.yaml grouping.py hotel-reservation offpolicy.py replay.py requirements.txt scalers.py scheduler.py setup-node.sh simulator.py social-network traces train-ticket utils.py worker-daemon.py root@autothrottle-1:
 
 # setup master
 ssh root@autothrottle-1 ./setup-node.sh master
@@ -28,7 +28,7 @@ rsync -avz root@autothrottle-1:join-command :kube-config tmp/
 
 for i in {2..5}; do
     # upload to worker
-    rsync -avz setup-node.sh worker-daemon.py tmp/join-command tmp/kube-config root@autothrottle-$i:
+    rsync -avz scheduler.py setup-node.sh worker-daemon.py tmp/join-command tmp/kube-config root@autothrottle-$i:
 
     # setup worker
     ssh root@autothrottle-$i ./setup-node.sh worker
@@ -52,6 +52,9 @@ elif [ "$1" = worker ]; then
     mkdir -p .kube
     cp kube-config .kube/config
 
+    # numpy for the batch Captain engine of the worker daemon
+    apt-get install -y python3-numpy
+
     # run worker daemon in background
     tmux new-session -d './worker-daemon.py'
 fi
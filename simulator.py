@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import json
+import math
+import pathlib
+
+import numpy
+
+from scalers import default_targets, scaler_params, worker_daemon
+from utils import DummyTower, load_stats, load_trace
+
+
+# CPU seconds each component spends per request, from the CPU usage and the RPS recorded in a benchmark
+def load_profile(path):
+    rps = load_stats(path, 'rps')['_tower']
+    requests = sum(v * (t2 - t1) for (t1, v), (t2, _) in zip(rps, rps[1:]))
+    profile = {}
+    for component, usage in load_stats(path, 'cpu_usage').items():
+        # counters start over when a pod restarts, so only the increments count
+        profile[component] = sum(max(0, v2 - v1) for (_, v1), (_, v2) in zip(usage, usage[1:])) / requests
+    return profile
+
+
+# weighted percentile of (latency, count) pairs
+def percentile(latencies, q):
+    latencies = sorted(i for i in latencies if i[1])
+    total = sum(i[1] for i in latencies)
+    if not total:
+        return 0
+    rank = total * q / 100
+    for latency, count in latencies:
+        rank -= count
+        if rank <= 0:
+            return latency
+    return latencies[-1][0]
+
+
+# runs an application on simulated nodes instead of a cluster, with the same scalers and towers as benchmark()
+# nodes, scalers and tower are what benchmark() takes, trace is the RPS of each second
+# profile is the CPU seconds each component spends per request, see load_profile
+#
+# time advances in steps of one CFS period (the 0.1 s the daemons also use), every component is a queue of CPU work:
+# the requests arriving in a step (Poisson) add their work, and at most limit * period of it runs in the step,
+# shared fairly when the components of a node want more than its CPUs
+# a step is throttled when work is left over after the quota ran out
+# requests visit every component and wait for the work queued ahead of them there,
+# so the latencies are comparable between runs rather than with the real application
+# with hint_horizon, the scalers get the rps hints benchmark() sends, see CaptainScaler.hint
+def simulate(nodes, trace, scalers, tower, profile, node_cpus=32, period=1, latency_window=10, warmup=0, seed=0, batch=True, hint_horizon=None):
+    tick = 0.1
+    ticks_per_second = round(1 / tick)
+    components = sorted(sum(nodes.values(), []))
+    index = {name: i for i, name in enumerate(components)}
+    node_rows = [numpy.array([index[i] for i in node_components], dtype=int) for node_components in nodes.values()]
+    cost = numpy.array([profile[i] for i in components], dtype=float)
+    rng = numpy.random.default_rng(seed)
+
+    scaler_objects = {k: worker_daemon.init_scaler(v) for k, v in scalers.items()}
+    captain_batch = None
+    captains = [
+        name for name, scaler in scaler_objects.items()
+        if isinstance(scaler, worker_daemon.CaptainScaler) and not scaler.adaptive
+    ]
+    if batch and captains:
+        captain_batch = worker_daemon.CaptainBatch({name: scaler_objects[name] for name in captains})
+        scaler_objects.update(captain_batch.scalers())
+        captain_rows = numpy.array([index[name] for name in captains], dtype=int)
+    others = [(index[name], scaler) for name, scaler in scaler_objects.items() if name not in captains or captain_batch is None]
+
+    limit = numpy.full(len(components), math.inf)
+    backlog = numpy.zeros(len(components))
+    usage = numpy.zeros(len(components))
+    nr_periods = numpy.zeros(len(components))
+    nr_throttled = numpy.zeros(len(components))
+
+    window = collections.deque(maxlen=round(latency_window / tick))
+    latencies = []
+    counts = []
+    allocations = []
+    tower_allocation = 0
+    tower_ticks = 0
+    tower_requests = 0
+    tower_rows = []
+    limit_changes = 0
+    for k in range(len(trace) * ticks_per_second):
+        t = k * tick
+        arrivals = rng.poisson(trace[k // ticks_per_second] * tick)
+        backlog += arrivals * cost
+        quota = limit * tick
+        run = numpy.minimum(backlog, quota)
+        # components of a node share its CPUs
+        for rows in node_rows:
+            total = run[rows].sum()
+            if total > node_cpus * tick:
+                run[rows] *= node_cpus * tick / total
+        backlog -= run
+        usage += run
+        nr_periods += run > 0
+        nr_throttled += (backlog > 1e-9) & (run >= quota * (1 - 1e-9))
+        # the requests of this step wait for the work queued ahead of them, at the rate the limits allow
+        latency = float((backlog / numpy.minimum(limit, node_cpus)).sum() + cost.sum())
+        window.append((latency, arrivals))
+        if t >= warmup:
+            latencies.append(latency)
+            counts.append(arrivals)
+
+        last_limit = limit.copy()
+        if captain_batch is not None:
+            captain_batch.advance(t, numpy.arange(len(captains)), usage[captain_rows], nr_throttled[captain_rows])
+            limit[captain_rows] = numpy.maximum(0.01, captain_batch.limit)
+        for i, scaler in others:
+            new_limit = scaler(t, {
+                'cpu_usage': usage[i],
+                'cpu_stat.nr_periods': nr_periods[i],
+                'cpu_stat.nr_throttled': nr_throttled[i],
+            })
+            limit[i] = math.inf if new_limit is None else max(0.01, new_limit)
+
+        allocation = float(numpy.minimum(limit, node_cpus).sum())
+        if t >= warmup:
+            allocations.append(allocation)
+            limit_changes += int((limit != last_limit).sum())
+        tower_allocation += allocation
+        tower_ticks += 1
+        tower_requests += arrivals
+
+        if (k + 1) % round(period * ticks_per_second) == 0:
+            stats = collections.defaultdict(dict)
+            stats['_tower'] = {
+                'rps': tower_requests / period,
+                'p50_latency': percentile(window, 50),
+                'p99_latency': percentile(window, 99),
+                'allocation': tower_allocation / tower_ticks,
+            }
+            tower_allocation = 0
+            tower_ticks = 0
+            tower_requests = 0
+            updates = tower(t + tick, stats, scalers)
+            for name, v in updates.items():
+                if name in scaler_objects:
+                    scaler_objects[name].update(*v)
+            if hint_horizon is not None:
+                second = (k + 1) // ticks_per_second
+                rps = stats['_tower']['rps']
+                stats['_tower']['predicted_rps'] = max([rps, *trace[second:second + hint_horizon]])
+                if captain_batch is not None:
+                    captain_batch.hint(rps, stats['_tower']['predicted_rps'])
+                    limit[captain_rows] = numpy.maximum(0.01, captain_batch.limit)
+                for i, scaler in others:
+                    new_limit = scaler.hint(rps, stats['_tower']['predicted_rps'])
+                    if new_limit is not None:
+                        limit[i] = max(0.01, new_limit)
+            tower_rows.append((t + tick, stats['_tower']))
+
+    return {
+        'p99_latency': percentile(zip(latencies, counts), 99),
+        'allocation': sum(allocations) / len(allocations) if allocations else None,
+        'average_rps': sum(counts) / (len(counts) * tick) if counts else 0,
+        'limit_changes': limit_changes,
+        'tower': tower_rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='simulate an application under a scaler, driven by an RPS trace')
+    parser.add_argument('profile', help='benchmark directory to take the CPU cost of each component from')
+    parser.add_argument('trace', help='RPS trace, one line per second')
+    parser.add_argument('--trace-multiplier', type=float, default=1)
+    parser.add_argument('--nodes', help='JSON file of {node: [component, ...]}, defaults to all components on one node')
+    parser.add_argument('--node-cpus', type=float, default=32)
+    parser.add_argument('--scaler', choices=['captain', 'k8s-cpu', 'k8s-cpu-fast', 'const'], default='captain')
+    parser.add_argument('--targets', type=float, nargs='+', help='defaults to the default_targets of the scaler in scalers.py')
+    parser.add_argument('--initial-limit', type=float, default=32)
+    parser.add_argument('--warmup', type=float, default=0, help='seconds excluded from latency and allocation')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    if args.nodes is not None:
+        nodes = json.loads(pathlib.Path(args.nodes).read_text())
+    else:
+        nodes = {'node': sorted(profile)}
+    trace = [i * args.trace_multiplier for i in load_trace(args.trace)]
+    print('target', 'allocation', 'p99_latency', sep='\t')
+    for target in args.targets or default_targets[args.scaler]:
+        params = scaler_params(args.scaler, target, args.initial_limit)
+        result = simulate(
+            nodes=nodes,
+            trace=trace,
+            scalers={i: {'type': args.scaler, 'params': params} for i in sum(nodes.values(), [])},
+            tower=DummyTower(),
+            profile=profile,
+            node_cpus=args.node_cpus,
+            warmup=args.warmup,
+            seed=args.seed,
+        )
+        print(target, f'{result["allocation"]:.3f}', f'{result["p99_latency"]:.3f}', sep='\t')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,25 @@
 import collections
+import concurrent.futures
 import dataclasses
 import datetime
+import hashlib
+import itertools
 import json
 import lzma
+import math
+import multiprocessing
 import numpy
 import pathlib
 import random
 import socket
 import subprocess
+import threading
 import time
 import traceback
 import vowpalwabbit
+import zlib
+
+from scheduler import Ticker
 
 
 def load_trace(p):
@@ -25,11 +34,16 @@ def load_samples(path):
     path = pathlib.Path(path)
     with lzma.open(path/'stats.json.xz', 'rt') as f:
         stats = json.load(f)
+    return tower_samples(stats['_tower'])
+
+
+# the (rps, action, action_p, p99_latency, allocation) samples of the [(t, stats['_tower'])] rows of a benchmark
+def tower_samples(rows):
     samples = []
     last_rps = None
     last_action = None
     last_action_p = None
-    for t, d in stats['_tower']:
+    for t, d in rows:
         if last_rps is not None:
             samples.append((last_rps, last_action, last_action_p, d['p99_latency'], d['allocation']))
             last_rps = None
@@ -89,115 +103,279 @@ class ExploreTower:
 
 
 class VwTower:
+    # the model and how it is trained, offpolicy.py compares other values on recorded samples
     learning_rate = 0.5
-
-    def __init__(self, scaler, targets, target1components, slo, samples=(), explore=0.1, drop_samples=0, aggregate_samples=20):
+    hidden_units = 3
+    train_examples = 10000
+    aggregation = 'median'
+
+    # the model is kept between calls: new samples are learned as they arrive, and every refit_interval calls
+    # a new model is trained from all samples in a background thread, then replaces the current one
+    # the table of its decisions (see policy) is compiled for every new model, and a learned sample updates its row
+    # until the first model exists, calls train it in the foreground like every call used to
+    # model is the path of a saved model to start with instead, see save
+    # the actions are the combinations of targets for dimensions groups of components, for __call__ that is 2:
+    # target1components and the others, FactoredVwTower uses a one-dimensional VwTower for each of its groups
+    def __init__(self, scaler, targets, target1components, slo, samples=(), explore=0.1, drop_samples=0, aggregate_samples=20, refit_interval=60, model=None, dimensions=2):
         self.scaler = scaler
         self.targets = targets
         self.target1components = target1components
         self.slo = slo
+        self.dimensions = dimensions
+        self.actions = len(targets) ** dimensions
         self.samples = list(samples)
         self.explore = explore
         self.drop_samples = drop_samples
         self.aggregate_samples = aggregate_samples
+        self.refit_interval = refit_interval
+        self.model = model
         self.last_rps = None
         self.last_action = None
         self.last_action_p = None
 
-    def __call__(self, t, stats, scalers):
-        if self.last_rps is not None:
-            if self.drop_samples:
-                self.drop_samples -= 1
-            else:
-                latency = stats['_tower']['p99_latency']
-                allocation = stats['_tower']['allocation']
-                self.samples.append((self.last_rps, self.last_action, self.last_action_p, latency, allocation))
-
-        train_samples = list(self.samples)
+        # the samples as rows of an array that doubles when it is full, for aggregate
+        self.sample_array = numpy.array(self.samples, dtype=float).reshape(-1, 5)
+        self.sample_count = len(self.samples)
+
+        # cost normalization bounds and aggregation buckets, kept up to date as samples arrive
+        rps, action, _, latency, allocation = self.sample_array.T
+        met = latency <= self.slo
+        self.min_allocation = float(allocation[met].min()) if met.any() else None
+        self.max_allocation = float(allocation[met].max()) if met.any() else None
+        self.min_latency = float(latency[~met].min()) if (~met).any() else None
+        self.max_latency = float(latency[~met].max()) if (~met).any() else None
+        bucket = numpy.round(rps / self.aggregate_samples).astype(int) * self.aggregate_samples
+        self.buckets = set(zip(action.astype(int).tolist(), bucket.tolist()))
+        self.max_rps = float(rps.max()) if len(rps) else 0
+
+        self.vw = None
+        self.calls_since_refit = 0
+        self.refit_thread = None
+        self.refit_vw = None
+        self.refit_start = 0
+        self.table = None
+
+    def add_sample(self, sample):
+        self.samples.append(sample)
+        if self.sample_count == len(self.sample_array):
+            sample_array = numpy.empty((max(64, 2 * len(self.sample_array)), 5))
+            sample_array[:self.sample_count] = self.sample_array
+            self.sample_array = sample_array
+        self.sample_array[self.sample_count] = sample
+        self.sample_count += 1
+
+        rps, action, action_p, latency, allocation = sample
+        if latency <= self.slo:
+            self.min_allocation = allocation if self.min_allocation is None else min(self.min_allocation, allocation)
+            self.max_allocation = allocation if self.max_allocation is None else max(self.max_allocation, allocation)
+        else:
+            self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+            self.max_latency = latency if self.max_latency is None else max(self.max_latency, latency)
+        self.buckets.add((action, round(rps / self.aggregate_samples) * self.aggregate_samples))
+        self.max_rps = max(self.max_rps, rps)
+
+    def cost(self, latency, allocation):
+        if latency <= self.slo:
+            try:
+                return (allocation - self.min_allocation) / (self.max_allocation - self.min_allocation)
+            except ZeroDivisionError:
+                return 0.5
+        else:
+            try:
+                return (latency - self.min_latency) / (self.max_latency - self.min_latency) + 2
+            except ZeroDivisionError:
+                return 2.5
+
+    # cost of arrays of latencies and allocations
+    def costs(self, latency, allocation):
+        met = latency <= self.slo
+        result = numpy.where(met, 0.5, 2.5)
+        if met.any() and self.max_allocation != self.min_allocation:
+            result[met] = (allocation[met] - self.min_allocation) / (self.max_allocation - self.min_allocation)
+        if (~met).any() and self.max_latency != self.min_latency:
+            result[~met] = (latency[~met] - self.min_latency) / (self.max_latency - self.min_latency) + 2
+        return result
 
-        try:
-            min_allocation = min(i[4] for i in train_samples if i[3] <= self.slo)
-            max_allocation = max(i[4] for i in train_samples if i[3] <= self.slo)
-        except ValueError:
-            min_allocation = None
-            max_allocation = None
-        try:
-            min_latency = min(i[3] for i in train_samples if i[3] > self.slo)
-            max_latency = max(i[3] for i in train_samples if i[3] > self.slo)
-        except ValueError:
-            min_latency = None
-            max_latency = None
-        for i, (rps, action, action_p, latency, allocation) in enumerate(train_samples):
-            if latency <= self.slo:
-                try:
-                    cost = (allocation - min_allocation) / (max_allocation - min_allocation)
-                except ZeroDivisionError:
-                    cost = 0.5
-            else:
-                try:
-                    cost = (latency - min_latency) / (max_latency - min_latency) + 2
-                except ZeroDivisionError:
-                    cost = 2.5
-            train_samples[i] = (rps, action, action_p, cost)
-
-        def median(l):
-            l = sorted(l)
-            if not l:
-                return None
-            if len(l) % 2:
-                return l[len(l) // 2]
-            else:
-                return (l[len(l) // 2 - 1] + l[len(l) // 2]) / 2
-        sample_categories = collections.defaultdict(lambda: collections.defaultdict(list))
-        for i in train_samples:
-            action = i[1]
-            rps = round(i[0] / self.aggregate_samples) * self.aggregate_samples
-            sample_categories[action][rps].append(i)
-        aggregated_samples = []
-        for action in sample_categories:
-            for rps in sample_categories[action]:
-                aggregated_samples.append((rps, action, 1 / len(self.targets) ** 2, median(i[3] for i in sample_categories[action][rps])))
-        train_samples = []
+    # the median (or mean, see aggregation) cost of each action at each multiple of aggregate_samples,
+    # as (rps, action, action_p, cost)
+    # samples are (rps, action, action_p, p99_latency, allocation) rows, as a list or an array
+    def aggregate(self, samples):
+        samples = numpy.asarray(samples, dtype=float).reshape(-1, 5)
+        if not len(samples):
+            return []
+        rps, action, _, latency, allocation = samples.T
+        cost = self.costs(latency, allocation)
+        bucket = numpy.round(rps / self.aggregate_samples).astype(int)
+        action = action.astype(int)
+        # samples sorted by (action, bucket, cost), each group is a run of equal (action, bucket)
+        # costs are within [0, 3], so one sort of 4 * group + cost keeps the groups apart
+        group = action * (bucket.max() + 1) + bucket
+        order = numpy.argsort(group * 4.0 + cost)
+        action = action[order]
+        bucket = bucket[order]
+        cost = cost[order]
+        group = group[order]
+        first = numpy.flatnonzero(numpy.r_[True, group[1:] != group[:-1]])
+        count = numpy.diff(numpy.r_[first, len(cost)])
+        if self.aggregation == 'median':
+            group_cost = (cost[first + (count - 1) // 2] + cost[first + count // 2]) / 2
+        else:
+            group_cost = numpy.add.reduceat(cost, first) / count
+        action_p = 1 / self.actions
+        return [
+            (b * self.aggregate_samples, a, action_p, c)
+            for b, a, c in zip(bucket[first].tolist(), action[first].tolist(), group_cost.tolist())
+        ]
+
+    # a new model trained from scratch on samples, the way every call used to train it
+    def train(self, samples):
+        aggregated_samples = self.aggregate(samples)
+        vw = vowpalwabbit.Workspace(f'--cb_explore {self.actions} --epsilon 0 -l {self.learning_rate} --nn {self.hidden_units} --quiet')
         if aggregated_samples:
-            for i in range(10000):
-                train_samples.append(random.choice(aggregated_samples))
-
-        vw = vowpalwabbit.Workspace(f'--cb_explore {len(self.targets) ** 2} --epsilon 0 -l {self.learning_rate} --nn 3 --quiet')
-        for rps, action, action_p, cost in train_samples:
-            vw.learn(f'{action+1}:{cost}:{action_p} | rps:{rps}')
-
-        rps = stats['_tower']['rps']
-        distribution = vw.predict(f'| rps:{rps}')
+            examples = [f'{action+1}:{cost}:{action_p} | rps:{rps}' for rps, action, action_p, cost in aggregated_samples]
+            for i in numpy.random.randint(len(examples), size=self.train_examples).tolist():
+                vw.learn(examples[i])
+        return vw
+
+    # one new sample, learned as often as a refit would show its bucket, so it weighs the same
+    def learn(self, vw, sample):
+        rps, action, action_p, latency, allocation = sample
+        rps = round(rps / self.aggregate_samples) * self.aggregate_samples
+        example = f'{action+1}:{self.cost(latency, allocation)}:{1 / self.actions} | rps:{rps}'
+        for _ in range(max(1, self.train_examples // len(self.buckets))):
+            vw.learn(example)
+
+    def refit(self, samples):
+        self.refit_vw = self.train(samples)
+
+    # the action distributions of vw at every multiple of aggregate_samples from 0 up to max_rps, the rps the samples are
+    # aggregated at, as {'rps': [...], 'distribution': [...]}
+    # decisions look up the nearest rps instead of asking the model, and every table decisions are taken from
+    # is recorded as stats['_tower']['policy'] (and saved with checkpoints as policy.json)
+    def policy(self, vw, max_rps):
+        rps = [i * self.aggregate_samples for i in range(round(max_rps / self.aggregate_samples) + 1)]
+        return {'rps': rps, 'distribution': [vw.predict(f'| rps:{i}') for i in rps]}
+
+    # writes a checkpoint of the samples and the model trained on them, see tower_checkpoint_path
+    # the checkpoint is written next to path and then renamed, so a path that exists is complete
+    def save(self, path):
+        path = pathlib.Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.mkdir(parents=True, exist_ok=True)
+        vw = self.train(self.samples)
+        vw.save(str(temp_path/'model.vw'))
+        (temp_path/'policy.json').write_text(json.dumps(self.policy(vw, self.max_rps)))
+        vw.finish()
+        with lzma.open(temp_path/'samples.json.xz', 'wt') as f:
+            json.dump(self.samples, f)
+        (temp_path/'key.json').write_text(json.dumps(tower_checkpoint_key(self.slo, self.target1components, self.targets, self.aggregate_samples)))
+        temp_path.rename(path)
+
+    # when the model picks action for sure, the tower still tries the neighbouring targets of each group with explore in total
+    def explore_distribution(self, action):
+        distribution = [0] * self.actions
+        distribution[action] += 1 - self.explore
+        explore_actions = []
+        for d in range(self.dimensions):
+            stride = len(self.targets) ** (self.dimensions - 1 - d)
+            x = action // stride % len(self.targets)
+            if x - 1 >= 0:
+                explore_actions.append(action - stride)
+            if x + 1 < len(self.targets):
+                explore_actions.append(action + stride)
+        for i in explore_actions:
+            distribution[i] += self.explore / len(explore_actions)
+        return distribution
+
+    # the sample of the last decision, with the p99 latency and the allocation that followed it
+    def observe(self, latency, allocation):
+        if self.last_rps is None:
+            return
+        if self.drop_samples:
+            self.drop_samples -= 1
+            return
+        sample = (self.last_rps, self.last_action, self.last_action_p, latency, allocation)
+        self.add_sample(sample)
+        if self.vw is not None:
+            self.learn(self.vw, sample)
+            self.update_table(self.last_rps)
+
+    # predicts the row of the table at rps again, after the model learned a sample there
+    # the other rows catch up with the next refit, a row that changes gives a new table, see policy
+    def update_table(self, rps):
+        i = round(rps / self.aggregate_samples)
+        if self.table is None or i >= len(self.table['rps']):
+            return
+        distribution = self.vw.predict(f'| rps:{self.table["rps"][i]}')
+        if distribution != self.table['distribution'][i]:
+            self.table = {
+                'rps': self.table['rps'],
+                'distribution': [*self.table['distribution'][:i], distribution, *self.table['distribution'][i + 1:]],
+            }
+
+    # swaps in a finished refit, trains the first model, and starts a refit when it is due
+    # the table of a new model is compiled right away
+    def refresh(self):
+        # a finished refit replaces the model, after learning the samples that arrived while it was training
+        retrained = False
+        if self.refit_thread is not None and not self.refit_thread.is_alive():
+            retrained = True
+            self.refit_thread = None
+            for sample in self.samples[self.refit_start:]:
+                self.learn(self.refit_vw, sample)
+            self.vw.finish()
+            self.vw = self.refit_vw
+            self.refit_vw = None
+        if self.vw is None:
+            if self.model is not None:
+                self.vw = vowpalwabbit.Workspace(f'-i {self.model} --quiet')
+            else:
+                self.vw = self.train(self.samples)
+            retrained = True
+            self.calls_since_refit = 0
+        if retrained:
+            self.table = self.policy(self.vw, self.max_rps)
+        self.calls_since_refit += 1
+        if self.calls_since_refit >= self.refit_interval and self.refit_thread is None:
+            self.calls_since_refit = 0
+            self.refit_start = len(self.samples)
+            self.refit_thread = threading.Thread(target=self.refit, args=(self.sample_array[:self.sample_count].copy(),), daemon=True)
+            self.refit_thread.start()
+
+    # picks an action for rps, returns (action, action_p, explore), explore is the action the model was certain of
+    # before exploring around it, or None
+    # an rps above the table gets a new table from the same model that covers it
+    def decide(self, rps):
+        i = round(rps / self.aggregate_samples)
+        if i >= len(self.table['rps']):
+            self.table = self.policy(self.vw, max(self.max_rps, rps))
+        distribution = self.table['distribution'][i]
         action = numpy.random.choice(len(distribution), p=numpy.array(distribution) / sum(distribution))
         action_p = distribution[action]
 
-        vw.finish()
-
+        explore = None
         if action_p == 1:
-            stats['_tower']['explore'] = action
-            distribution = [0] * len(self.targets) ** 2
-            distribution[action] += 1 - self.explore
-            explore_actions = []
-            x = action // len(self.targets)
-            y = action % len(self.targets)
-            if x - 1 >= 0:
-                explore_actions.append(action - len(self.targets))
-            if x + 1 < len(self.targets):
-                explore_actions.append(action + len(self.targets))
-            if y - 1 >= 0:
-                explore_actions.append(action - 1)
-            if y + 1 < len(self.targets):
-                explore_actions.append(action + 1)
-            for i in explore_actions:
-                distribution[i] += self.explore / len(explore_actions)
+            explore = action
+            distribution = self.explore_distribution(action)
             action = numpy.random.choice(len(distribution), p=numpy.array(distribution) / sum(distribution))
             action_p = distribution[action]
 
-        stats['_tower']['action'] = action
-        stats['_tower']['action_p'] = action_p
         self.last_rps = rps
         self.last_action = action
         self.last_action_p = action_p
+        return action, action_p, explore
+
+    def __call__(self, t, stats, scalers):
+        table = self.table
+        self.observe(stats['_tower'].get('p99_latency'), stats['_tower'].get('allocation'))
+        self.refresh()
+        action, action_p, explore = self.decide(stats['_tower']['rps'])
+        if self.table is not table:
+            stats['_tower']['policy'] = self.table
+        if explore is not None:
+            stats['_tower']['explore'] = explore
+        stats['_tower']['action'] = action
+        stats['_tower']['action_p'] = action_p
 
         target1 = self.targets[action // len(self.targets)]
         target2 = self.targets[action % len(self.targets)]
@@ -212,6 +390,230 @@ class VwTower:
         return updates
 
 
+# index of the group of each component, components in none of the groups are in the last one
+def component_groups(components, groups):
+    result = {}
+    for k in components:
+        result[k] = len(groups) - 1
+        for i, group in enumerate(groups):
+            if k in group:
+                result[k] = i
+                break
+    return result
+
+
+# ExploreTower for any number of groups of components, each group explores its own targets
+# an action is a list of target indices, one for each group, which keeps the action space at len(targets) per group
+# instead of len(targets) ** len(groups)
+class FactoredExploreTower:
+    def __init__(self, scaler, targets, groups, samples=(), warmup=0):
+        self.scaler = scaler
+        self.targets = targets
+        self.groups = groups
+        self.explore_count = [{i: 0 for i in range(len(self.targets))} for _ in self.groups]
+        for i in samples:
+            for g, action in enumerate(i[1]):
+                self.explore_count[g][action] += 1
+        self.stage = -warmup - 1
+        self.action = None
+
+    def __call__(self, t, stats, scalers):
+        if self.stage < 0:
+            self.stage += 1
+            return {}
+
+        if self.stage == 0:
+            self.stage = 1
+            self.action = []
+            for explore_count in self.explore_count:
+                min_explore_count = min(explore_count.values())
+                action = random.choice([k for k, v in explore_count.items() if v == min_explore_count])
+                explore_count[action] += 1
+                self.action.append(action)
+            print(f'{self.action=}')
+            groups = component_groups(scalers, self.groups)
+            updates = {}
+            for k, v in scalers.items():
+                if v['type'] == self.scaler:
+                    updates[k] = (self.targets[self.action[groups[k]]],)
+            return updates
+
+        if self.stage == 1:
+            self.stage = 0
+            stats['_tower']['action'] = self.action
+            stats['_tower']['action_p'] = [1 / len(self.targets)] * len(self.groups)
+            return {}
+
+
+# VwTower for any number of groups of components, with a one-dimensional VwTower learning the targets of each group
+# every group learns the cost of its own targets at each rps, whatever the other groups do at the same time,
+# so training grows with the number of groups instead of exponentially
+# each group explores explore / len(groups) of its decisions, so all groups together explore at most explore of them,
+# like a single VwTower, instead of 1 - (1 - explore) ** len(groups)
+# actions and action_p are recorded as lists with one entry for each group, and so are the samples it takes
+# (see tower_samples), the refits of the groups are spread over refit_interval
+# model is the path of a checkpoint written by save to start with, like the model of VwTower
+class FactoredVwTower:
+    def __init__(self, scaler, targets, groups, slo, samples=(), explore=0.1, drop_samples=0, aggregate_samples=20, refit_interval=60, model=None):
+        self.scaler = scaler
+        self.targets = targets
+        self.groups = groups
+        self.slo = slo
+        self.aggregate_samples = aggregate_samples
+        self.refit_interval = refit_interval
+        self.learners = [
+            VwTower(
+                scaler=scaler,
+                targets=targets,
+                target1components=None,
+                slo=slo,
+                samples=[(rps, action[g], action_p[g], latency, allocation) for rps, action, action_p, latency, allocation in samples],
+                explore=explore / len(groups),
+                drop_samples=drop_samples,
+                aggregate_samples=aggregate_samples,
+                refit_interval=refit_interval,
+                model=None if model is None else pathlib.Path(model)/f'model-{g}.vw',
+                dimensions=1,
+            )
+            for g in range(len(groups))
+        ]
+        self.started = False
+
+    # writes a checkpoint like VwTower.save, with a model-{g}.vw and a policy for each group
+    # the samples are put back together from the learners, which all keep the same samples with their own actions
+    def save(self, path):
+        path = pathlib.Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.mkdir(parents=True, exist_ok=True)
+        policy = []
+        for g, learner in enumerate(self.learners):
+            vw = learner.train(learner.samples)
+            vw.save(str(temp_path/f'model-{g}.vw'))
+            policy.append(learner.policy(vw, learner.max_rps))
+            vw.finish()
+        (temp_path/'policy.json').write_text(json.dumps(policy))
+        samples = [
+            (group_samples[0][0], [i[1] for i in group_samples], [i[2] for i in group_samples], group_samples[0][3], group_samples[0][4])
+            for group_samples in zip(*(learner.samples for learner in self.learners))
+        ]
+        with lzma.open(temp_path/'samples.json.xz', 'wt') as f:
+            json.dump(samples, f)
+        (temp_path/'key.json').write_text(json.dumps(tower_checkpoint_key(self.slo, (), self.targets, self.aggregate_samples, self.groups)))
+        temp_path.rename(path)
+
+    def __call__(self, t, stats, scalers):
+        tables = [learner.table for learner in self.learners]
+        for learner in self.learners:
+            learner.observe(stats['_tower'].get('p99_latency'), stats['_tower'].get('allocation'))
+            learner.refresh()
+        if not self.started:
+            self.started = True
+            for g, learner in enumerate(self.learners):
+                learner.calls_since_refit += g * self.refit_interval // len(self.learners)
+
+        decisions = [learner.decide(stats['_tower']['rps']) for learner in self.learners]
+        if any(learner.table is not table for learner, table in zip(self.learners, tables)):
+            stats['_tower']['policy'] = [learner.table if learner.table is not table else None for learner, table in zip(self.learners, tables)]
+        if any(explore is not None for _, _, explore in decisions):
+            stats['_tower']['explore'] = [explore for _, _, explore in decisions]
+        stats['_tower']['action'] = [action for action, _, _ in decisions]
+        stats['_tower']['action_p'] = [action_p for _, action_p, _ in decisions]
+
+        groups = component_groups(scalers, self.groups)
+        updates = {}
+        for k, v in scalers.items():
+            if v['type'] == self.scaler:
+                updates[k] = (self.targets[decisions[groups[k]][0]],)
+        return updates
+
+
+# what the samples of a VwTower checkpoint were learned for
+# the actions are pairs of targets for target1components and the other components, and the costs depend on the slo
+# the model is trained on rps rounded to aggregate_samples, so it only fits towers with the same aggregate_samples
+# checkpoints of FactoredVwTower have groups instead of target1components
+def tower_checkpoint_key(slo, target1components, targets, aggregate_samples, groups=None):
+    key = {
+        'slo': slo,
+        'target1components': sorted(target1components),
+        'targets': list(targets),
+        'aggregate_samples': aggregate_samples,
+    }
+    if groups is not None:
+        key['groups'] = [sorted(i) for i in groups]
+    return key
+
+
+# directory of the VwTower checkpoint (see VwTower.save) of an application under root
+def tower_checkpoint_path(root, application, slo, target1components, targets, aggregate_samples, groups=None):
+    key = json.dumps(tower_checkpoint_key(slo, target1components, targets, aggregate_samples, groups), sort_keys=True)
+    return pathlib.Path(root)/application/hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+# the samples of a VwTower checkpoint, or None if there is no checkpoint at path
+# pass them and path/'model.vw' to VwTower to start from the saved policy
+def load_tower_checkpoint(path):
+    path = pathlib.Path(path)
+    if not path.exists():
+        return None
+    with lzma.open(path/'samples.json.xz', 'rt') as f:
+        return [tuple(i) for i in json.load(f)]
+
+
+# the tower of the TowerProcess this process is the worker of
+process_tower = None
+
+
+def tower_process_init(tower):
+    global process_tower
+    process_tower = tower
+
+
+def tower_process_call(t, stats, scalers):
+    updates = process_tower(t, stats, scalers)
+    return updates, stats['_tower']
+
+
+class TowerProcess:
+    # runs a tower in a worker process, so a slow decision does not hold up the controller loop
+    # at most one request is in flight, requests made while the tower is busy are skipped
+    # the worker is forked when the TowerProcess is created, create it before starting any threads
+    def __init__(self, tower):
+        self.executor = concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('fork'), tower_process_init, (tower,))
+        self.executor.submit(int).result()
+        self.future = None
+        self.row = None
+        self.request_time = None
+        self.skipped = 0
+
+    # sends a snapshot of stats to the tower, returns False if it is still busy with the previous one
+    # row is stats['_tower'] as recorded, the decision adds action, action_p and explore to it
+    def request(self, t, stats, scalers):
+        if self.future is not None:
+            self.skipped += 1
+            return False
+        self.row = stats['_tower']
+        self.request_time = time.perf_counter()
+        self.future = self.executor.submit(tower_process_call, t, dict(stats), scalers)
+        return True
+
+    # the decision as (updates, row, request_time), waiting at most timeout seconds for it, or None if it is not ready
+    def take(self, timeout=0):
+        if self.future is None:
+            return None
+        concurrent.futures.wait([self.future], timeout)
+        if not self.future.done():
+            return None
+        updates, tower_stats = self.future.result()
+        self.row.update(tower_stats)
+        result = (updates, self.row, self.request_time)
+        self.future = None
+        self.row = None
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
 def kubectl_apply(k8s_json, namespace, pod_count):
     def all_ready(output):
         l = output.splitlines()
@@ -309,7 +711,112 @@ def parse_locust_stats_history(temp_dir):
         return result
 
 
-def benchmark(output_dir, namespace, locustfile, url, nodes, deploy, teardown, scalers, tower, locust_workers):
+# worker daemons return stats as columns, {'time': [...], metric: [...]}
+# convert them back to the [(t, {metric: value})] rows stored in stats.json.xz, dropping missing (NaN) values
+def stats_rows(columns):
+    columns = {k: numpy.asarray(v).tolist() for k, v in columns.items()}
+    metrics = [k for k in columns if k != 'time']
+    rows = []
+    for i, t in enumerate(columns['time']):
+        row = {}
+        for k in metrics:
+            v = columns[k][i]
+            if not math.isnan(v):
+                row[k] = v
+        rows.append((t, row))
+    return rows
+
+
+# read the stats of a stats/stop reply, data is the already parsed first line of the reply
+# binary replies are followed by frames (see StatsStore.frames in worker-daemon.py), decoded one at a time
+def recv_stats(node_socket, data):
+    if data.get('encoding', 'json') == 'json':
+        return data['stats']
+    times = []
+    columns = collections.defaultdict(lambda: collections.defaultdict(list))
+    while True:
+        header = json.loads(node_socket.readline())
+        if header.get('end'):
+            break
+        a = numpy.frombuffer(zlib.decompress(node_socket.read(header['size'])), dtype={'d': '<f8', 'q': '<i8'}[header['type']])
+        assert len(a) == header['count']
+        if header['delta']:
+            a = numpy.cumsum(a)
+        if header['type'] != 'd' and (a < 0).any():
+            # missing integer values are sent as -1
+            a = numpy.where(a < 0, numpy.nan, a)
+        if header['divisor'] != 1:
+            a = a / header['divisor']
+        if header['component'] is None:
+            times.append(a)
+        else:
+            columns[header['component']][header['metric']].append(a)
+    if not times:
+        return {}
+    times = numpy.concatenate(times)
+    result = {}
+    for component, metrics in columns.items():
+        result[component] = {'time': times}
+        for k, v in metrics.items():
+            result[component][k] = numpy.concatenate(v)
+    return result
+
+
+class NodeSubscription:
+    # live view of one worker daemon session, kept up to date by the stats the daemon pushes every interval
+    def __init__(self, node, session, interval):
+        node_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        node_socket.connect((node, 12198))
+        self.node_socket = node_socket.makefile('rwb')
+        self.node_socket.write((json.dumps({
+            'method': 'subscribe',
+            'session': session,
+            'interval': interval,
+            'encoding': 'binary',
+        }) + '\n').encode())
+        self.node_socket.flush()
+        data = json.loads(self.node_socket.readline())
+        assert data['ok']
+
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.limit_sum = collections.defaultdict(float)
+        self.limit_count = collections.defaultdict(int)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            line = self.node_socket.readline()
+            if not line:
+                break
+            data = json.loads(line)
+            assert data['ok']
+            if data.get('event') == 'stopped':
+                break
+            stats = recv_stats(self.node_socket, data)
+            with self.lock:
+                for component, columns in stats.items():
+                    self.latest[component] = {k: v[-1] for k, v in columns.items()}
+                    l = numpy.asarray(columns.get('scaler.limit', []), dtype=float)
+                    l = l[~numpy.isnan(l)]
+                    self.limit_sum[component] += l.sum()
+                    self.limit_count[component] += len(l)
+        self.node_socket.close()
+
+    # average limit of each component since the previous call
+    def take_limit_averages(self):
+        with self.lock:
+            result = {k: float(self.limit_sum[k] / n) for k, n in self.limit_count.items() if n}
+            self.limit_sum.clear()
+            self.limit_count.clear()
+        return result
+
+    def join(self):
+        self.thread.join()
+
+
+def benchmark(output_dir, namespace, locustfile, url, nodes, deploy, teardown, scalers, tower, locust_workers, period=1, subscribe_interval=0.2, batch=False, hint_horizon=None, priorities={}, async_tower=False):
     output_dir = pathlib.Path(output_dir)
     if output_dir.exists():
         print('skipped:', output_dir)
@@ -317,24 +824,37 @@ def benchmark(output_dir, namespace, locustfile, url, nodes, deploy, teardown, s
 
     print('start:', output_dir)
     pathlib.Path('request.log').unlink(missing_ok=True)
+    # with hint_horizon, the daemons are told the highest rps of the next hint_horizon seconds of rps.txt
+    if hint_horizon is not None:
+        trace = load_trace('rps.txt')
+    # with async_tower, the tower decides in a worker process, and the loop goes on when it takes longer than half a period
+    # its decision is applied as soon as it is ready, the time from the request until then is recorded as tower_latency
+    # a late decision is still recorded on the row that requested it, so its sample is paired with the latency from
+    # before it took effect, and the tower learns from the rows it did not skip, which is why it is off by default
+    tower_process = TowerProcess(tower) if async_tower else None
     deploy()
 
     node_sockets = {}
     for node, node_components in nodes.items():
         node_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         node_socket.connect((node, 12198))
-        node_sockets[node] = node_socket.makefile('rw')
-        node_sockets[node].write(json.dumps({
+        node_sockets[node] = node_socket.makefile('rwb')
+        node_sockets[node].write((json.dumps({
             'method': 'start',
             'namespace': namespace,
             'components': node_components,
             'scalers': {i: scalers[i] for i in node_components if i in scalers},
-        }) + '\n')
+            'encoding': 'binary',
+            'batch': batch,
+            'priorities': {i: priorities[i] for i in node_components if i in priorities},
+        }) + '\n').encode())
         node_sockets[node].flush()
-    for node_socket in node_sockets.values():
+    subscriptions = {}
+    for node, node_socket in node_sockets.items():
         line = node_socket.readline()
         data = json.loads(line)
         assert data['ok']
+        subscriptions[node] = NodeSubscription(node, data['session'], subscribe_interval)
     print('all nodes started')
 
     time_ = datetime.datetime.utcnow().isoformat() + 'Z'
@@ -349,11 +869,11 @@ def benchmark(output_dir, namespace, locustfile, url, nodes, deploy, teardown, s
             time_base = time.time()
             monotonic_base = time.time() - time.perf_counter()
             locust_t = None
+            # locust writes a row only every few seconds, the hints go out every tick with the rps of the latest row
+            last_rps = None
+            ticker = Ticker(period)
             while True:
-                t = time.perf_counter()
-                tt = (-t) % 1
-                t += tt
-                time.sleep(tt)
+                t = ticker.wait()
                 if p.poll() is not None:
                     break
 
@@ -370,44 +890,65 @@ def benchmark(output_dir, namespace, locustfile, url, nodes, deploy, teardown, s
                 do_tower = False
                 if stats:
                     do_tower = True
-                    print('fetch all stats')
-                    for node_socket in node_sockets.values():
-                        node_socket.write(json.dumps({
-                            'method': 'stats',
-                        }) + '\n')
-                        node_socket.flush()
-                    local_stats = {}
-                    for node_socket in node_sockets.values():
-                        line = node_socket.readline()
-                        data = json.loads(line)
-                        assert data['ok']
-                        local_stats.update(data['stats'])
+                    limits = {}
+                    for subscription in subscriptions.values():
+                        limits.update(subscription.take_limit_averages())
                     allocation = 0
                     for component in scalers:
-                        l = [i[1]['scaler.limit'] for i in local_stats[component]]
-                        if l:
-                            allocation += sum(l) / len(l)
+                        if component in limits:
+                            allocation += limits[component]
                         else:
                             print('empty local stats')
                             do_tower = False
                     stats['_tower']['allocation'] = allocation
-                    print('fetch all stats done')
 
+                tower_updates = None
+                decision = None
                 if do_tower:
-                    tower_updates = tower(t, stats, scalers)
-                    if tower_updates:
-                        print('tower update')
-                        for node_socket in node_sockets.values():
-                            node_socket.write(json.dumps({
-                                'method': 'update',
-                                'update': tower_updates,
-                            }) + '\n')
-                            node_socket.flush()
-                        for node_socket in node_sockets.values():
-                            line = node_socket.readline()
-                            data = json.loads(line)
-                            assert data['ok']
-                        print('tower update done')
+                    if tower_process is None:
+                        tower_updates = tower(t, stats, scalers)
+                    elif not tower_process.request(t, stats, scalers):
+                        print('tower busy')
+                if tower_process is not None:
+                    # a decision ready within half a period is applied in this tick, a slower one in a later tick
+                    decision = tower_process.take(max(0, t + period / 2 - time.perf_counter()))
+                    if decision is not None:
+                        tower_updates = decision[0]
+                if tower_updates:
+                    print('tower update')
+                    for node_socket in node_sockets.values():
+                        node_socket.write((json.dumps({
+                            'method': 'update',
+                            'update': tower_updates,
+                        }) + '\n').encode())
+                        node_socket.flush()
+                    for node_socket in node_sockets.values():
+                        line = node_socket.readline()
+                        data = json.loads(line)
+                        assert data['ok']
+                    print('tower update done')
+                if decision is not None:
+                    _, row, request_time = decision
+                    row['tower_latency'] = time.perf_counter() - request_time
+                    print('tower latency', row['tower_latency'])
+
+                if '_tower' in stats:
+                    last_rps = stats['_tower']['rps']
+                if hint_horizon is not None and last_rps is not None:
+                    second = int(time.time() - time_base)
+                    predicted_rps = max([last_rps, *trace[second:second + hint_horizon]])
+                    if '_tower' in stats:
+                        stats['_tower']['predicted_rps'] = predicted_rps
+                    for node_socket in node_sockets.values():
+                        node_socket.write((json.dumps({
+                            'method': 'hint',
+                            'hint': {'rps': last_rps, 'predicted_rps': predicted_rps},
+                        }) + '\n').encode())
+                        node_socket.flush()
+                    for node_socket in node_sockets.values():
+                        line = node_socket.readline()
+                        data = json.loads(line)
+                        assert data['ok']
 
                 if '_tower' in stats:
                     print(stats['_tower'])
@@ -418,26 +959,48 @@ def benchmark(output_dir, namespace, locustfile, url, nodes, deploy, teardown, s
             traceback.print_exc()
             teardown()
             raise
+        finally:
+            if tower_process is not None:
+                tower_process.shutdown()
 
     for node_socket in node_sockets.values():
-        node_socket.write(json.dumps({
+        node_socket.write((json.dumps({
             'method': 'stop',
-        }) + '\n')
+        }) + '\n').encode())
         node_socket.flush()
-    for node_socket in node_sockets.values():
+    node_stats = {}
+    stop_t = time.perf_counter() + monotonic_base
+    stats_history['_scheduler'] = [(stop_t, ticker.to_dict())]
+    if tower_process is not None:
+        stats_history['_scheduler'][0][1]['tower_skipped'] = tower_process.skipped
+    for node, node_socket in node_sockets.items():
         line = node_socket.readline()
         data = json.loads(line)
         assert data['ok']
-        for k, v in data['stats'].items():
-            assert k not in stats_history
-            stats_history[k] = v
+        if 'scheduler' in data:
+            stats_history[f'_scheduler-{node}'] = [(stop_t, data['scheduler'])]
+        for k, v in recv_stats(node_socket, data).items():
+            assert k not in stats_history and k not in node_stats
+            node_stats[k] = v
+    for subscription in subscriptions.values():
+        subscription.join()
 
     for p in worker_ps:
         p.wait()
 
-    stats_history_relative_time = {k: [(t - time_base, v) for t, v in l] for k, l in stats_history.items()}
+    # same output as json.dump of the whole dict, but daemon stats are expanded into rows one component at a time
     with lzma.open(temp_dir/'stats.json.xz', 'wt') as f:
-        json.dump(stats_history_relative_time, f)
+        f.write('{')
+        for i, k in enumerate(itertools.chain(list(stats_history), list(node_stats))):
+            if k in stats_history:
+                l = stats_history[k]
+            else:
+                l = stats_rows(node_stats.pop(k))
+            if i:
+                f.write(', ')
+            f.write(json.dumps(k) + ': ')
+            json.dump([(t - time_base, v) for t, v in l], f)
+        f.write('}')
 
     with lzma.open(temp_dir/'request.log.xz', 'wt') as fo:
         with open('request.log', 'rt') as fi:
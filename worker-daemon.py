@@ -1,57 +1,205 @@
 #!/usr/bin/env python3
+import argparse
+import array
+import asyncio
 import collections
+import functools
+import itertools
 import json
+import math
+import operator
+import os
 import pathlib
 import socket
 import statistics
-import subprocess
+import sys
 import time
 import threading
 import traceback
+import zlib
 
+from scheduler import Histogram, Ticker
+
+# only needed by CaptainBatch, workers install it with apt-get install python3-numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class StatsStore:
+    # columnar, append-only storage of per-tick samples
+    # each column is a list of preallocated fixed-size typed arrays, so appending never moves existing data
+    # integer columns store raw counters and are divided by their divisor when read
+    # missing values are NaN in float columns and -1 in integer columns, both are read as NaN
+    # single producer: the sampling thread fills a row between begin() and commit(), and commit() publishes it
+    # readers take length once and only read rows below it, published rows are never written again,
+    # so readers get consistent snapshots through zero-copy memoryviews without locking the producer
+    chunk_size = 3000
+
+    def __init__(self):
+        self.length = 0
+        self.time = []
+        self.columns = {}
+        self.current = {}
+        self.offset = self.chunk_size
+
+    def add_column(self, component, metric, typecode='d', divisor=1):
+        assert self.length == 0
+        self.columns[component, metric] = typecode, divisor, []
+
+    def _allocate(self, typecode):
+        if typecode == 'd':
+            return array.array('d', [float('nan')]) * self.chunk_size
+        return array.array(typecode, [-1]) * self.chunk_size
+
+    def begin(self, t):
+        self.offset = self.length % self.chunk_size
+        if self.offset == 0:
+            self.time.append(self._allocate('d'))
+            for k, (typecode, _, chunks) in self.columns.items():
+                chunks.append(self._allocate(typecode))
+                self.current[k] = chunks[-1]
+        self.time[-1][self.offset] = t
+
+    def set(self, component, metric, value):
+        self.current[component, metric][self.offset] = value
+
+    def commit(self):
+        self.length += 1
+
+    def _slices(self, chunks, start, stop):
+        for i in range(start // self.chunk_size, (stop - 1) // self.chunk_size + 1):
+            yield memoryview(chunks[i])[max(start - i * self.chunk_size, 0):min(stop - i * self.chunk_size, self.chunk_size)]
+
+    def _read(self, chunks, start, stop, divisor=1):
+        result = []
+        nan = float('nan')
+        for chunk in self._slices(chunks, start, stop):
+            if chunk.format == 'd':
+                result.extend(chunk.tolist())
+            elif divisor == 1:
+                result.extend(v if v >= 0 else nan for v in chunk)
+            else:
+                result.extend(v / divisor if v >= 0 else nan for v in chunk)
+        return result
+
+    def read_column(self, component, metric, start=0, stop=None):
+        if stop is None:
+            stop = self.length
+        if start >= stop:
+            return []
+        _, divisor, chunks = self.columns[component, metric]
+        return self._read(chunks, start, stop, divisor)
+
+    def read(self, start=0, stop=None):
+        if stop is None:
+            stop = self.length
+        if start >= stop:
+            return {}
+        times = self._read(self.time, start, stop)
+        result = {}
+        for (component, metric), (_, divisor, chunks) in self.columns.items():
+            result.setdefault(component, {'time': times})[metric] = self._read(chunks, start, stop, divisor)
+        return result
+
+    # binary encoding of read(), one frame per column per chunk, so a frame never exceeds chunk_size samples
+    # each frame is a JSON header line followed by a zlib-compressed little-endian array
+    # integer columns are delta-encoded within each frame, the first value is absolute
+    def frames(self, start=0, stop=None):
+        if stop is None:
+            stop = self.length
+        if start >= stop:
+            return
+        columns = [(None, 'time', 'd', 1, self.time)]
+        columns += [(component, metric, typecode, divisor, chunks) for (component, metric), (typecode, divisor, chunks) in self.columns.items()]
+        for component, metric, typecode, divisor, chunks in columns:
+            for view in self._slices(chunks, start, stop):
+                delta = typecode != 'd'
+                if delta:
+                    chunk = array.array(typecode, view[:1])
+                    chunk.extend(map(operator.sub, view[1:], view[:-1]))
+                elif sys.byteorder == 'big':
+                    chunk = array.array(typecode, view)
+                else:
+                    chunk = view
+                if sys.byteorder == 'big':
+                    chunk.byteswap()
+                payload = zlib.compress(chunk, 1)
+                yield {
+                    'component': component,
+                    'metric': metric,
+                    'type': typecode,
+                    'divisor': divisor,
+                    'delta': delta,
+                    'count': len(chunk),
+                    'size': len(payload),
+                }, payload
+
+
+class CgroupV1:
+    # cgroup v1 with the systemd driver, cpu and cpuacct have their own hierarchies
+    root = pathlib.Path('/sys/fs/cgroup')
+
+    def qos_path(self, qos, family='cpu'):
+        return self.root/family/f'kubepods.slice/kubepods-{qos}.slice'
+
+    def stat_path(self, pod, stat):
+        qos, uid = pod
+        family, _, name = stat.partition('.')
+        return self.qos_path(qos, family)/f'kubepods-{qos}-pod{uid.replace("-", "_")}.slice'/f'{family}.{name}'
+
+    # [(path, [(metric, key in the file or None for a single-value file, multiplier to ns)])]
+    def stat_files(self, pod):
+        return [
+            (self.stat_path(pod, 'cpuacct.usage'), [('usage', None, 1)]),
+            (self.stat_path(pod, 'cpu.stat'), [
+                ('nr_periods', 'nr_periods', 1),
+                ('nr_throttled', 'nr_throttled', 1),
+                ('throttled_time', 'throttled_time', 1),
+            ]),
+        ]
+
+    def actuator(self, pod):
+        return CgroupV1Actuator(self, pod)
 
-def get_pod_map(namespace, components):
-    name_to_uid = {}
-    p = subprocess.run(['kubectl', 'get', 'pods', f'-n={namespace}',
-        r'-o=jsonpath={range .items[*]}{.metadata.uid} {.metadata.name}{"\n"}{end}'],
-        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True, check=True)
-    for i in p.stdout.splitlines():
-        uid, name = i.split()
-        name = name.rsplit('-', 2)[0]
-        if name in components:
-            assert name not in name_to_uid
-            name_to_uid[name] = uid
-
-    uid_to_qos = {}
-    cgroup = pathlib.Path('/sys/fs/cgroup')
-    for qos in ['guaranteed', 'burstable', 'besteffort']:
-        d = cgroup/f'cpu/kubepods.slice/kubepods-{qos}.slice'
-        p = f'kubepods-{qos}-pod'
-        s = '.slice'
-        for i in d.glob(f'{p}*{s}'):
-            uid = i.name[len(p):-len(s)].replace('_', '-')
-            uid_to_qos[uid] = qos
-
-    pod_map = {}
-    for name in components:
-        uid = name_to_uid[name]
-        try:
-            qos = uid_to_qos[uid]
-        except KeyError:
-            pass
-        else:
-            pod_map[name] = qos, uid
-    return pod_map
 
+class CgroupV2:
+    # unified hierarchy, usage and throttling are both in cpu.stat, and cpu.max sets quota and period in one write
+    root = pathlib.Path('/sys/fs/cgroup')
 
-def stat_path(pod_map, name, stat):
-    qos, uid = pod_map[name]
-    family, _, name = stat.partition('.')
-    slices = f'kubepods.slice/kubepods-{qos}.slice/kubepods-{qos}-pod{uid.replace("-", "_")}.slice'
-    return pathlib.Path(f'/sys/fs/cgroup/{family}/{slices}/{family}.{name}')
+    def qos_path(self, qos):
+        return self.root/f'kubepods.slice/kubepods-{qos}.slice'
 
+    def stat_path(self, pod, stat):
+        qos, uid = pod
+        return self.qos_path(qos)/f'kubepods-{qos}-pod{uid.replace("-", "_")}.slice'/stat
 
-def set_cpu_limit(pod_map, name, limit, period=0.1):
+    def stat_files(self, pod):
+        return [
+            (self.stat_path(pod, 'cpu.stat'), [
+                ('usage', 'usage_usec', 1000),
+                ('nr_periods', 'nr_periods', 1),
+                ('nr_throttled', 'nr_throttled', 1),
+                ('throttled_time', 'throttled_usec', 1000),
+            ]),
+        ]
+
+    def actuator(self, pod):
+        return CgroupV2Actuator(self, pod)
+
+
+def detect_cgroup():
+    if (CgroupV2.root/'cgroup.controllers').exists():
+        return CgroupV2()
+    return CgroupV1()
+
+
+# the CFS period the actuators set, independent of how often the node samples
+CFS_PERIOD = 0.1
+
+
+def cpu_quota(limit, period):
     period_us = round(period * 1e6)
     assert 1000 <= period_us <= 1000000
     if limit is None:
@@ -59,8 +207,226 @@ def set_cpu_limit(pod_map, name, limit, period=0.1):
     else:
         quota_us = round(limit * period_us)
         assert quota_us >= 1000
-    stat_path(pod_map, name, 'cpu.cfs_period_us').write_text(str(period_us))
-    stat_path(pod_map, name, 'cpu.cfs_quota_us').write_text(str(quota_us))
+    return period_us, quota_us
+
+
+# the kernel checks every single write, so the intermediate (quota, period) must be valid too
+# write first whatever gives the lower intermediate ratio, an unlimited quota is always valid
+def quota_first(old_quota_us, old_period_us, quota_us, period_us):
+    if quota_us == -1:
+        return True
+    if old_quota_us == -1:
+        return False
+    return quota_us / old_period_us <= old_quota_us / period_us
+
+
+class CgroupV1Actuator:
+    # keeps cpu.cfs_quota_us and cpu.cfs_period_us of a pod open, and only writes the values that changed
+    def __init__(self, cgroup, pod):
+        self.quota_fd = os.open(cgroup.stat_path(pod, 'cpu.cfs_quota_us'), os.O_RDWR)
+        try:
+            self.period_fd = os.open(cgroup.stat_path(pod, 'cpu.cfs_period_us'), os.O_RDWR)
+        except OSError:
+            os.close(self.quota_fd)
+            raise
+        self.quota_us = int(os.pread(self.quota_fd, 64, 0))
+        self.period_us = int(os.pread(self.period_fd, 64, 0))
+
+    def set(self, limit, period=CFS_PERIOD):
+        period_us, quota_us = cpu_quota(limit, period)
+        if period_us == self.period_us:
+            if quota_us != self.quota_us:
+                os.pwrite(self.quota_fd, str(quota_us).encode(), 0)
+        elif quota_first(self.quota_us, self.period_us, quota_us, period_us):
+            os.pwrite(self.quota_fd, str(quota_us).encode(), 0)
+            os.pwrite(self.period_fd, str(period_us).encode(), 0)
+        else:
+            os.pwrite(self.period_fd, str(period_us).encode(), 0)
+            os.pwrite(self.quota_fd, str(quota_us).encode(), 0)
+        self.quota_us = quota_us
+        self.period_us = period_us
+
+    def close(self):
+        os.close(self.quota_fd)
+        os.close(self.period_fd)
+
+
+class CgroupV2Actuator:
+    # keeps cpu.max of a pod open, quota and period are changed together by one write
+    def __init__(self, cgroup, pod):
+        self.fd = os.open(cgroup.stat_path(pod, 'cpu.max'), os.O_RDWR)
+        quota, period = os.pread(self.fd, 64, 0).split()
+        self.quota_us = -1 if quota == b'max' else int(quota)
+        self.period_us = int(period)
+
+    def set(self, limit, period=CFS_PERIOD):
+        period_us, quota_us = cpu_quota(limit, period)
+        if (quota_us, period_us) != (self.quota_us, self.period_us):
+            os.pwrite(self.fd, f'{"max" if quota_us == -1 else quota_us} {period_us}'.encode(), 0)
+        self.quota_us = quota_us
+        self.period_us = period_us
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PodDiscovery:
+    # maps pods to cgroups from local state only, without a round trip to the API server
+    # pod names come from the labels the container runtime keeps for each container, each container is parsed once
+    runtimes = [
+        (pathlib.Path('/var/lib/docker/containers'), 'config.v2.json'),
+        (pathlib.Path('/run/containerd/io.containerd.runtime.v2.task/k8s.io'), 'config.json'),
+    ]
+
+    def __init__(self, cgroup):
+        self.cgroup = cgroup
+        self.containers = {}
+
+    @staticmethod
+    def labels(path):
+        data = json.loads(path.read_text())
+        if 'Config' in data:
+            labels = data['Config'].get('Labels') or {}
+            return labels.get('io.kubernetes.pod.uid'), labels.get('io.kubernetes.pod.namespace'), labels.get('io.kubernetes.pod.name')
+        annotations = data.get('annotations') or {}
+        return annotations.get('io.kubernetes.cri.sandbox-uid'), annotations.get('io.kubernetes.cri.sandbox-namespace'), annotations.get('io.kubernetes.cri.sandbox-name')
+
+    # returns ({uid: (namespace, pod name)}, {uid: qos}) of the pods currently on this node
+    def scan(self):
+        containers = {}
+        for root, config in self.runtimes:
+            if not root.is_dir():
+                continue
+            for d in root.iterdir():
+                if d in self.containers:
+                    containers[d] = self.containers[d]
+                    continue
+                try:
+                    containers[d] = self.labels(d/config)
+                except (OSError, ValueError):
+                    # being created or removed, try again next time
+                    continue
+        self.containers = containers
+        pods = {uid: (namespace, name) for uid, namespace, name in containers.values() if uid is not None}
+
+        uid_to_qos = {}
+        for qos in ['guaranteed', 'burstable', 'besteffort']:
+            d = self.cgroup.qos_path(qos)
+            p = f'kubepods-{qos}-pod'
+            s = '.slice'
+            for i in d.glob(f'{p}*{s}'):
+                uid = i.name[len(p):-len(s)].replace('_', '-')
+                uid_to_qos[uid] = qos
+        return pods, uid_to_qos
+
+    # current is the pod map in use, its pods are kept as long as they exist, e.g. while a replacement pod starts
+    def pod_map(self, scan, namespace, components, current={}):
+        pods, uid_to_qos = scan
+        candidates = {}
+        for uid, qos in uid_to_qos.items():
+            if uid in pods and pods[uid][0] == namespace:
+                name = pods[uid][1].rsplit('-', 2)[0]
+                if name in components:
+                    candidates.setdefault(name, []).append((qos, uid))
+        pod_map = {}
+        for name in components:
+            l = candidates.get(name, [])
+            if current.get(name) in l:
+                pod_map[name] = current[name]
+            elif len(l) == 1:
+                pod_map[name] = l[0]
+        return pod_map
+
+
+class CgroupSampler:
+    # keeps the stat files of all components open as raw file descriptors and reads them with preadv into reused buffers
+    # the offset of each needed field is learned when a file is opened, afterwards decode() checks the key at that offset
+    # and parses only the digits after it, searching the buffer again only when the offset moved (a value grew a digit)
+    # a component whose files cannot be read, e.g. because its pod is gone, is left out of decode()
+    metrics = ('usage', 'nr_periods', 'nr_throttled', 'throttled_time')
+    buffer_size = 4096
+
+    def __init__(self, cgroup):
+        self.cgroup = cgroup
+        self.files = {}
+
+    def open(self, name, pod):
+        self.close(name)
+        files = []
+        try:
+            for path, fields in self.cgroup.stat_files(pod):
+                fd = os.open(path, os.O_RDONLY)
+                buffer = bytearray(self.buffer_size)
+                files.append([fd, buffer, 0, None])
+                size = os.preadv(fd, [buffer], 0)
+                layout = []
+                for metric, key, multiplier in fields:
+                    if key is None:
+                        layout.append([self.metrics.index(metric), None, 0, multiplier])
+                    else:
+                        key = key.encode() + b' '
+                        offset = self.find(buffer, size, key, 0)
+                        if offset < 0:
+                            raise ValueError(f'{key} not found in {path}')
+                        layout.append([self.metrics.index(metric), key, offset, multiplier])
+                files[-1][3] = layout
+        except (OSError, ValueError):
+            for f in files:
+                os.close(f[0])
+            raise
+        self.files[name] = files
+
+    # offset of key at the start of a line of buffer[:size], -1 if there is none, starting at the line at offset
+    # the bytes after size are left over from longer reads, so offset is only trusted while its line is within size
+    @staticmethod
+    def find(buffer, size, key, offset):
+        if offset + len(key) < size and buffer.find(key, offset, offset + len(key)) == offset and (offset == 0 or buffer[offset - 1] == 10):
+            return offset
+        offset = -1
+        while True:
+            offset = buffer.find(key, offset + 1, size)
+            if offset <= 0 or buffer[offset - 1] == 10:
+                return offset
+
+    def read(self):
+        for files in self.files.values():
+            for f in files:
+                try:
+                    f[2] = os.preadv(f[0], [f[1]], 0)
+                except OSError:
+                    f[2] = 0
+
+    # returns {name: [usage_ns, nr_periods, nr_throttled, throttled_time_ns]} of the last read()
+    def decode(self):
+        result = {}
+        for name, files in self.files.items():
+            values = [0, 0, 0, 0]
+            for _, buffer, size, layout in files:
+                if not size:
+                    break
+                for field in layout:
+                    metric, key, offset, multiplier = field
+                    if key is None:
+                        values[metric] = int(buffer[:size]) * multiplier
+                        continue
+                    offset = self.find(buffer, size, key, offset)
+                    if offset < 0:
+                        break
+                    field[2] = offset
+                    start = offset + len(key)
+                    end = buffer.find(b'\n', start, size)
+                    values[metric] = int(buffer[start:size if end < 0 else end]) * multiplier
+                else:
+                    continue
+                break
+            else:
+                result[name] = values
+        return result
+
+    def close(self, name=None):
+        for i in [name] if name is not None else list(self.files):
+            for f in self.files.pop(i, []):
+                os.close(f[0])
 
 
 class ConstScaler:
@@ -73,14 +439,91 @@ class ConstScaler:
     def update(self, limit):
         self.limit = limit
 
+    def reset(self):
+        pass
+
+    def hint(self, rps, predicted_rps):
+        return None
+
+    # the limit is a setting rather than state, it is asked for again
+    def grant(self, limit):
+        pass
+
+
+class RollingWindow:
+    # the last size values in a ring buffer, with their running sum and sum of squared deviations (Welford),
+    # so push(), mean() and stdev() are O(1) whatever the size
+    # the running values are recomputed from the buffer every time it wraps around, so rounding errors cannot pile up
+    def __init__(self, size, initial=0.0):
+        self.size = size
+        self.values = array.array('d', [initial]) * size
+        self.pos = 0
+        self.clear(initial)
+
+    def clear(self, value=0.0):
+        for i in range(self.size):
+            self.values[i] = value
+        self.pos = 0
+        self.count = 0
+        self.sum = value * self.size
+        self.m2 = 0.0
+
+    def push(self, x):
+        old = self.values[self.pos]
+        self.values[self.pos] = x
+        self.pos += 1
+        self.count = min(self.count + 1, self.size)
+        if self.pos == self.size:
+            self.pos = 0
+            self.sum = math.fsum(self.values)
+            mean = self.sum / self.size
+            self.m2 = math.fsum((i - mean) ** 2 for i in self.values)
+            return
+        old_mean = self.sum / self.size
+        self.sum += x - old
+        self.m2 = max(0.0, self.m2 + (x - old) * (x - self.sum / self.size + old - old_mean))
+
+    def mean(self):
+        return self.sum / self.size
+
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.size - 1))
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class SlidingMax:
+    # maximum of the last size values, with a deque of the values that can still become the maximum,
+    # in decreasing order, so push() is amortized O(1) and max() is O(1)
+    def __init__(self, size, initial=None):
+        self.size = size
+        self.count = 0
+        self.candidates = collections.deque()
+        if initial is not None:
+            for _ in range(size):
+                self.push(initial)
+
+    def push(self, x):
+        while self.candidates and self.candidates[-1][1] <= x:
+            self.candidates.pop()
+        self.candidates.append((self.count, x))
+        self.count += 1
+        if self.candidates[0][0] <= self.count - 1 - self.size:
+            self.candidates.popleft()
+
+    def max(self):
+        return self.candidates[0][1]
+
 
 class K8sCPUScalerBase:
     def __init__(self, period, stabilization, target, initial_limit):
+        assert target > 0
         self.period = period
         self.target = target
         self.limit = initial_limit
         self.recommend_len = stabilization // period
-        self.recommendations = []
+        self.recommendations = SlidingMax(self.recommend_len)
 
         self.last_t = None
         self.last_stats = None
@@ -99,14 +542,24 @@ class K8sCPUScalerBase:
         return self.limit
 
     def scale(self, usage):
-        self.recommendations.append(usage / self.target)
-        if len(self.recommendations) > self.recommend_len:
-            self.recommendations.pop(0)
-        self.limit = max(self.recommendations)
+        self.recommendations.push(usage / self.target)
+        self.limit = self.recommendations.max()
 
     def update(self, target):
         self.target = target
 
+    # the pod was replaced, its counters start over
+    def reset(self):
+        self.last_t = None
+        self.last_stats = None
+
+    def hint(self, rps, predicted_rps):
+        return None
+
+    # the node's Arbiter granted less than the limit asked for
+    def grant(self, limit):
+        self.limit = limit
+
 
 class K8sCPUScaler(K8sCPUScalerBase):
     def __init__(self, target, initial_limit=1):
@@ -119,19 +572,39 @@ class K8sCPUFastScaler(K8sCPUScalerBase):
 
 
 class CaptainScaler:
-    def __init__(self, target, initial_limit=1):
+    # with adaptive, the period drops to one sample when throttling or usage spikes for more than one sample,
+    # and doubles after every scaling decision that does not scale up, up to max_period
+    # throttling spikes when the periods throttled since the last decision are already more than the target allows
+    # for the time since then, counted as at least 1 s,
+    # usage spikes when a sample is more than 3 stdevs above the mean of the usage history,
+    # with the stdev at least min_usage_std cores and 5% of the mean, so a flat history does not spike on noise
+    # tick is the sampling period of the node, the histories cover the same seconds at any tick,
+    # and the throttled counts are rated per CFS period rather than per sample
+    def __init__(self, target, initial_limit=1, adaptive=False, tick=0.1):
         # read-only parameters
         self.target = target
-        self.period = 1
+        self.adaptive = adaptive
+        self.tick = tick
+        self.periods_per_tick = tick / CFS_PERIOD
+        self.min_period = tick
+        self.max_period = 4
+        self.min_usage_std = 0.01
+        self.hint_ttl = 5
 
         # state
+        self.period = 1
         self.limit = initial_limit
         self.last_limit = initial_limit
-        self.throttled_history = [0 for _ in range(int(10 * self.period))]
-        self.usage_history = [0.0 for _ in range(50)]
+        self.throttled_history = RollingWindow(round((self.max_period if adaptive else self.period) / tick))
+        self.usage_history = RollingWindow(round(5 / tick))
+        self.usage_peak = SlidingMax(round(5 / tick), 0.0)
         self.margin = 3
+        self.spike_samples = 0
         self.scale_down_cd = 0
         self.last_scale_down = False
+        self.usage_per_rps = None
+        self.hint_limit = 0
+        self.hint_t = -math.inf
 
         self.last_t = None
         self.last_stats = None
@@ -145,200 +618,796 @@ class CaptainScaler:
             return self.limit
 
         new_throttled = stats['cpu_stat.nr_throttled'] - self.last_stats['cpu_stat.nr_throttled']
-        self.throttled_history.append(new_throttled)
-        self.throttled_history.pop(0)
         new_usage = (stats['cpu_usage'] - self.last_stats['cpu_usage']) / (t - self.last_t)
-        self.usage_history.append(new_usage)
-        self.usage_history.pop(0)
+        if self.adaptive and self.period > self.min_period:
+            elapsed = max(1, t - self.last_scale_t)
+            throttled_spike = self.throttled_history.sum + new_throttled > 3 * self.target * elapsed / CFS_PERIOD
+            usage_mean = self.usage_history.mean()
+            usage_std = max(self.usage_history.stdev(), self.min_usage_std, 0.05 * usage_mean)
+            usage_spike = new_usage > usage_mean + 3 * usage_std
+            self.spike_samples = self.spike_samples + 1 if throttled_spike or usage_spike else 0
+            if self.spike_samples > 1:
+                self.spike_samples = 0
+                self.period = self.min_period
+        self.throttled_history.push(new_throttled)
+        self.usage_history.push(new_usage)
+        self.usage_peak.push(new_usage)
         self.last_t = t
         self.last_stats = stats
-        throttled_rate = statistics.mean(self.throttled_history)
+        # a hint holds the limit up only while hints keep coming
+        if t - self.hint_t > self.hint_ttl:
+            self.hint_limit = 0
+        throttled_rate = self.throttled_rate()
         if throttled_rate > 3 * self.target and self.last_scale_down:
             self.limit = 2 * self.last_limit - self.limit
             self.margin += (throttled_rate - self.target)
-            self.throttled_history = [0 for _ in range(int(10 * self.period))]
+            self.throttled_history.clear()
             self.last_scale_down = False
 
         if t < self.last_scale_t + self.period - 0.0001:
             return self.limit
         self.last_limit = self.limit
-        throttled_rate = statistics.mean(self.throttled_history)
-        usage_max = max(self.usage_history)
-        usage_std = statistics.stdev(self.usage_history)
+        throttled_rate = self.throttled_rate()
+        usage_max = self.usage_peak.max()
+        usage_std = self.usage_history.stdev()
 
-        self.margin += (throttled_rate - self.target)
+        # the margin moves at the same speed per second whatever the period
+        self.margin += (throttled_rate - self.target) * self.period
         self.margin = max(0, self.margin)
         self.last_scale_down = False
+        # and the limit grows by the same factor per second, a short period takes a fraction of the step
         if throttled_rate > 3 * self.target:
-            self.limit *= 1 + (throttled_rate - 3 * self.target)
+            self.limit *= (1 + (throttled_rate - 3 * self.target)) ** self.period
         else:
             usage_limit = usage_max + usage_std * self.margin
             if usage_limit <= self.limit * 0.9 and self.scale_down_cd == 0:
-                self.limit = max(self.limit * 0.5, usage_limit)
+                self.limit = max(self.limit * 0.5, usage_limit, self.hint_limit)
                 self.last_scale_down = True
-        self.throttled_history = [0 for _ in range(int(10 * self.period))]
+        self.throttled_history.clear()
         self.limit = max(0.01, self.limit)
         self.last_scale_t = t
         stats['captain.margin'] = self.margin
+        stats['captain.period'] = self.period
+        if self.adaptive and self.limit <= self.last_limit:
+            self.period = min(self.max_period, self.period * 2)
         return self.limit
 
+    # feed-forward from the controller, the current rps and the highest rps expected soon
+    # learns the peak CPU usage per request, and keeps the limit at least at what the predicted rps needs,
+    # with the same margin as scaling down, so the limit grows before the requests arrive
+    # the hinted limit expires hint_ttl seconds after the last hint
+    # returns the raised limit, or None if the limit already covers the prediction
+    def hint(self, rps, predicted_rps):
+        if self.last_t is None or rps <= 0:
+            return None
+        ratio = self.usage_peak.max() / rps
+        if self.usage_per_rps is None:
+            self.usage_per_rps = ratio
+        else:
+            self.usage_per_rps = 0.9 * self.usage_per_rps + 0.1 * ratio
+        self.hint_limit = self.usage_per_rps * predicted_rps + self.usage_history.stdev() * self.margin
+        self.hint_t = self.last_t
+        if self.hint_limit <= self.limit:
+            return None
+        self.limit = self.hint_limit
+        self.last_scale_down = False
+        return self.limit
+
+    # fraction of the CFS periods throttled since the last scaling decision
+    # the fixed period always has a full window, an adaptive one may have been cut short by a spike
+    def throttled_rate(self):
+        if self.adaptive:
+            return self.throttled_history.sum / max(1, self.throttled_history.count * self.periods_per_tick)
+        return self.throttled_history.sum / (self.throttled_history.size * self.periods_per_tick)
+
     def update(self, target):
         self.target = target
 
+    # the pod was replaced, its counters start over
+    def reset(self):
+        self.last_t = None
+        self.last_stats = None
+
+    # the node's Arbiter granted less than the limit asked for, scaling goes on from the granted one
+    def grant(self, limit):
+        self.limit = limit
+
+
+class CaptainBatch:
+    # the state of many CaptainScaler instances as arrays, one row per component, stepped together once per tick
+    # each row makes the same decisions as its CaptainScaler would, the histories are ring buffers
+    # since only their sum, max and stdev are used
+    def __init__(self, scalers):
+        if numpy is None:
+            raise RuntimeError('batch mode needs numpy on the worker, install python3-numpy')
+        self.names = list(scalers)
+        scalers = list(scalers.values())
+        self.period = 1
+        assert all(not i.adaptive and i.period == self.period for i in scalers)
+        self.periods_per_tick = scalers[0].periods_per_tick
+        assert all(i.periods_per_tick == self.periods_per_tick for i in scalers)
+        n = len(scalers)
+
+        self.target = numpy.array([i.target for i in scalers], dtype=float)
+        self.limit = numpy.array([i.limit for i in scalers], dtype=float)
+        self.last_limit = numpy.array([i.last_limit for i in scalers], dtype=float)
+        self.throttled_history = numpy.array([list(i.throttled_history) for i in scalers], dtype=float).reshape(n, -1)
+        self.usage_history = numpy.array([list(i.usage_history) for i in scalers], dtype=float).reshape(n, -1)
+        self.throttled_pos = numpy.zeros(n, dtype=int)
+        self.usage_pos = numpy.zeros(n, dtype=int)
+        self.margin = numpy.array([i.margin for i in scalers], dtype=float)
+        self.scale_down_cd = numpy.array([i.scale_down_cd for i in scalers], dtype=float)
+        self.last_scale_down = numpy.array([i.last_scale_down for i in scalers], dtype=bool)
+        self.usage_per_rps = numpy.array([math.nan if i.usage_per_rps is None else i.usage_per_rps for i in scalers])
+        self.hint_limit = numpy.array([i.hint_limit for i in scalers], dtype=float)
+        self.hint_t = numpy.array([i.hint_t for i in scalers], dtype=float)
+        self.hint_ttl = scalers[0].hint_ttl
+
+        self.started = numpy.zeros(n, dtype=bool)
+        self.last_t = numpy.zeros(n)
+        self.last_usage = numpy.zeros(n)
+        self.last_throttled = numpy.zeros(n)
+        self.last_scale_t = numpy.zeros(n)
+
+    def scalers(self):
+        return {name: CaptainBatchScaler(self, i) for i, name in enumerate(self.names)}
+
+    # steps the rows of the components in stats, returns their limits and sets captain.margin like CaptainScaler
+    def __call__(self, t, stats):
+        rows = numpy.array([i for i, name in enumerate(self.names) if name in stats], dtype=int)
+        if len(rows) == 0:
+            return {}
+        usage = numpy.array([stats[self.names[i]]['cpu_usage'] for i in rows], dtype=float)
+        throttled = numpy.array([stats[self.names[i]]['cpu_stat.nr_throttled'] for i in rows], dtype=float)
+        for i in self.advance(t, rows, usage, throttled):
+            stats[self.names[i]]['captain.margin'] = float(self.margin[i])
+            stats[self.names[i]]['captain.period'] = self.period
+        return {self.names[i]: float(self.limit[i]) for i in rows}
+
+    # steps the given rows with their cpu_usage and nr_throttled counters, the new limits are in self.limit
+    # returns the rows that scaled in this step
+    def advance(self, t, rows, usage, throttled):
+        first = ~self.started[rows]
+        new = rows[first]
+        self.started[new] = True
+        self.last_t[new] = t
+        self.last_usage[new] = usage[first]
+        self.last_throttled[new] = throttled[first]
+        self.last_scale_t[new] = t
+        if first.all():
+            return rows[:0]
+        return self.step(t, rows[~first], usage[~first], throttled[~first])
+
+    # CaptainScaler.hint for all started rows, returns {name: raised limit}
+    def hint(self, rps, predicted_rps):
+        if rps <= 0:
+            return {}
+        rows = numpy.flatnonzero(self.started)
+        usage_history = self.usage_history[rows]
+        ratio = usage_history.max(axis=1) / rps
+        usage_per_rps = self.usage_per_rps[rows]
+        usage_per_rps = numpy.where(numpy.isnan(usage_per_rps), ratio, 0.9 * usage_per_rps + 0.1 * ratio)
+        self.usage_per_rps[rows] = usage_per_rps
+        hint_limit = usage_per_rps * predicted_rps + usage_history.std(axis=1, ddof=1) * self.margin[rows]
+        self.hint_limit[rows] = hint_limit
+        self.hint_t[rows] = self.last_t[rows]
+        raised = rows[hint_limit > self.limit[rows]]
+        self.limit[raised] = self.hint_limit[raised]
+        self.last_scale_down[raised] = False
+        return {self.names[i]: float(self.limit[i]) for i in raised}
+
+    def step(self, t, rows, usage, throttled):
+        throttled_width = self.throttled_history.shape[1]
+        usage_width = self.usage_history.shape[1]
+        self.throttled_history[rows, self.throttled_pos[rows]] = throttled - self.last_throttled[rows]
+        self.throttled_pos[rows] = (self.throttled_pos[rows] + 1) % throttled_width
+        self.usage_history[rows, self.usage_pos[rows]] = (usage - self.last_usage[rows]) / (t - self.last_t[rows])
+        self.usage_pos[rows] = (self.usage_pos[rows] + 1) % usage_width
+        self.last_t[rows] = t
+        self.last_usage[rows] = usage
+        self.last_throttled[rows] = throttled
+        self.hint_limit[rows[t - self.hint_t[rows] > self.hint_ttl]] = 0
+
+        target = self.target[rows]
+        limit = self.limit[rows]
+        last_limit = self.last_limit[rows]
+        margin = self.margin[rows]
+        last_scale_down = self.last_scale_down[rows]
+        throttled_history = self.throttled_history[rows]
+        throttled_rate = throttled_history.sum(axis=1) / (throttled_width * self.periods_per_tick)
+
+        # undo the last scale down as soon as it causes throttling
+        undo = (throttled_rate > 3 * target) & last_scale_down
+        limit[undo] = 2 * last_limit[undo] - limit[undo]
+        margin[undo] += (throttled_rate[undo] - target[undo])
+        throttled_history[undo] = 0
+        throttled_rate[undo] = 0
+        last_scale_down[undo] = False
+
+        scale = ~(t < self.last_scale_t[rows] + self.period - 0.0001)
+        if scale.any():
+            last_limit[scale] = limit[scale]
+            usage_history = self.usage_history[rows[scale]]
+            usage_max = usage_history.max(axis=1)
+            usage_std = usage_history.std(axis=1, ddof=1)
+            scale_rate = throttled_rate[scale]
+            scale_target = target[scale]
+            scale_margin = numpy.maximum(0, margin[scale] + (scale_rate - scale_target))
+            scale_limit = limit[scale]
+            up = scale_rate > 3 * scale_target
+            scale_limit[up] *= 1 + (scale_rate[up] - 3 * scale_target[up])
+            usage_limit = usage_max + usage_std * scale_margin
+            down = ~up & (usage_limit <= scale_limit * 0.9) & (self.scale_down_cd[rows[scale]] == 0)
+            scale_limit[down] = numpy.maximum(numpy.maximum(scale_limit[down] * 0.5, usage_limit[down]), self.hint_limit[rows[scale][down]])
+            limit[scale] = numpy.maximum(0.01, scale_limit)
+            margin[scale] = scale_margin
+            last_scale_down[scale] = down
+            throttled_history[scale] = 0
+            self.last_scale_t[rows[scale]] = t
+
+        self.limit[rows] = limit
+        self.last_limit[rows] = last_limit
+        self.margin[rows] = margin
+        self.last_scale_down[rows] = last_scale_down
+        self.throttled_history[rows] = throttled_history
+        return rows[scale]
+
 
-def init_scaler(data):
+class CaptainBatchScaler:
+    # stands in for one row of a CaptainBatch in Session.scalers, so updates and resets reach the batch
+    def __init__(self, batch, i):
+        self.batch = batch
+        self.i = i
+
+    def update(self, target):
+        self.batch.target[self.i] = target
+
+    def reset(self):
+        self.batch.started[self.i] = False
+
+    # hints reach all rows at once through CaptainBatch.hint
+    def hint(self, rps, predicted_rps):
+        return None
+
+    def grant(self, limit):
+        self.batch.limit[self.i] = limit
+
+
+# tick is the sampling period the scaler is stepped at, only the Captain scaler counts in samples
+def init_scaler(data, tick=0.1):
+    if data['type'] == 'captain':
+        return CaptainScaler(*data['params'], tick=tick)
     return {
         'const': ConstScaler,
         'k8s-cpu-fast': K8sCPUFastScaler,
         'k8s-cpu': K8sCPUScaler,
-        'captain': CaptainScaler,
     }[data['type']](*data['params'])
 
 
-def run(control, namespace, components, scalers):
-    pod_map = get_pod_map(namespace, components)
+class Arbiter:
+    # splits the CPU budget of a node between the limits the scalers of all sessions request
+    # requests that fit are granted as they are, otherwise every component gets a weighted max-min fair share:
+    # never more than it requested, and what the smaller requests leave is split in proportion to the weights
+    # every component keeps the minimum limit, only the budget above the minimums is shared,
+    # so the granted total is over the budget only when the minimums alone are
+    # unlimited requests (None) are passed through and not counted
+    min_limit = 0.01
 
-    limits = {}
-    for name in scalers:
-        assert name in components
-    for name in components:
-        limits[name] = None
-        set_cpu_limit(pod_map, name, None)
+    def __init__(self, budget):
+        assert budget > 0
+        self.budget = budget
+        self.requested = 0
+        self.granted = 0
 
-    files = {}
-    for name in components:
-        files[name, 'cpuacct.usage'] = stat_path(pod_map, name, 'cpuacct.usage').open()
-        files[name, 'cpu.stat'] = stat_path(pod_map, name, 'cpu.stat').open()
+    # requests is {key: (limit, weight)}, returns {key: granted limit}
+    def __call__(self, requests):
+        granted = {k: limit for k, (limit, _) in requests.items()}
+        capped = [(k, limit, weight) for k, (limit, weight) in requests.items() if limit is not None]
+        self.requested = sum(i[1] for i in capped)
+        if self.requested <= self.budget:
+            self.granted = self.requested
+            return granted
+        remaining = max(0, self.budget - self.min_limit * len(capped))
+        weights = sum(i[2] for i in capped)
+        for k, limit, weight in sorted(capped, key=lambda i: (i[1] - self.min_limit) / i[2]):
+            share = min(max(0, limit - self.min_limit), remaining * weight / weights)
+            granted[k] = self.min_limit + share
+            remaining -= share
+            weights -= weight
+        self.granted = sum(granted[i[0]] for i in capped)
+        return granted
 
-    monotonic_base = time.time() - time.perf_counter()
 
-    stats_history = collections.defaultdict(list)
-    control['stats'] = stats_history
+class Session:
+    # one controller connection, with its own namespace, components, scalers and stats
+    # sampled by the shared Node thread, see Node.run
+    def __init__(self, node, namespace, components, scalers, encoding, batch=False, priorities={}):
+        self.cgroup = node.cgroup
+        self.namespace = namespace
+        self.components = components
+        self.scalers = scalers
+        self.encoding = encoding
+        self.arbitrated = node.arbiter is not None
 
-    stats_current = collections.defaultdict(list)
-    control['stats_current'] = stats_current
+        for name in scalers:
+            assert name in components
+        for name, priority in priorities.items():
+            assert name in components and priority > 0
+        self.priorities = {name: priorities.get(name, 1) for name in components}
+        captains = [name for name, scaler in scalers.items() if isinstance(scaler, CaptainScaler)]
+        # in batch mode the Captain scalers with a fixed period are replaced by the rows of one CaptainBatch
+        self.batch = None
+        fixed = [name for name in captains if not scalers[name].adaptive]
+        if batch and fixed:
+            self.batch = CaptainBatch({name: scalers[name] for name in fixed})
+            scalers.update(self.batch.scalers())
+        self.limits = {name: None for name in components}
+        # the limits the scalers asked for in the current tick, applied as they are or as granted by the node's Arbiter
+        self.requested = {}
+        # per component EWMA of the fraction of CFS periods throttled, weighs the arbiter's shares
+        self.pressure = {name: 0 for name in components}
+        self.last_counters = {}
+        self.actuators = {}
+        self.sampler = CgroupSampler(self.cgroup)
+        self.pod_map = {}
+        # handoffs to the sampling thread, appended by other threads and drained by step() without blocking
+        self.updates = collections.deque()
+        self.hints = collections.deque(maxlen=1)
+        self.pod_maps = collections.deque(maxlen=1)
+        self.apply_pod_map(node.discovery.pod_map(node.discovery.scan(), namespace, components))
+        missing = [name for name in components if name not in self.pod_map]
+        if missing:
+            print(f'pods not found in {namespace}, waiting for them: {missing}')
 
-    late_end_time = 0
-    while True:
-        t = time.perf_counter()
-        tt = (0.097 - t) * 1000 % 100 / 1000
-        t += tt
-        time.sleep(tt)
-        if control['stop']:
-            break
+        self.daemon = f'_daemon-{socket.gethostname()}'
 
-        stats = collections.defaultdict(dict)
+        self.store = StatsStore()
         for name in components:
-            files[name, 'cpuacct.usage'].seek(0)
-            stats[name]['cpu_usage'] = files[name, 'cpuacct.usage'].read()
-            files[name, 'cpu.stat'].seek(0)
-            for line in files[name, 'cpu.stat'].read().splitlines():
-                k, v = line.split()
-                stats[name][f'cpu_stat.{k}'] = v
+            self.store.add_column(name, 'cpu_usage', 'q', 1e9)
+            self.store.add_column(name, 'cpu_stat.nr_periods', 'q')
+            self.store.add_column(name, 'cpu_stat.nr_throttled', 'q')
+            self.store.add_column(name, 'cpu_stat.throttled_time', 'q', 1e9)
+            self.store.add_column(name, 'scaler.limit')
+            if self.arbitrated:
+                self.store.add_column(name, 'scaler.requested')
+            if name in captains:
+                self.store.add_column(name, 'captain.margin')
+                self.store.add_column(name, 'captain.period')
+                self.store.add_column(name, 'captain.hint_limit')
+        self.store.add_column(self.daemon, 'sampler.read_time')
+        self.store.add_column(self.daemon, 'scheduler.lateness')
+        self.store.add_column(self.daemon, 'actuator.time')
+        self.store.add_column(self.daemon, 'actuator.count', 'q')
+        self.store.add_column(self.daemon, 'sampler.decode_time')
+        if self.arbitrated:
+            self.store.add_column(self.daemon, 'arbiter.requested')
+            self.store.add_column(self.daemon, 'arbiter.granted')
 
-        end_time = time.perf_counter()
-        if end_time > t + (-t * 1000 % 100 / 1000):
-            late_end_time += 1
+        self.cursor = 0
+        self.read_t = None
+        self.read_time = 0
+        self.late_end_time = 0
+        self.lateness = Histogram()
+        self.work_time = Histogram()
+        self.error = None
+        self.id = None
+        self.closed = False
 
-        for name in components:
-            stats[name]['cpu_usage'] = int(stats[name]['cpu_usage']) / 1e9
-            stats[name]['cpu_stat.nr_periods'] = int(stats[name]['cpu_stat.nr_periods'])
-            stats[name]['cpu_stat.nr_throttled'] = int(stats[name]['cpu_stat.nr_throttled'])
-            stats[name]['cpu_stat.throttled_time'] = int(stats[name]['cpu_stat.throttled_time']) / 1e9
+    # reopens the stat files of pods that changed, the limits are applied again on the next step
+    def apply_pod_map(self, pod_map):
+        for name in self.components:
+            pod = pod_map.get(name)
+            if pod == self.pod_map.get(name):
+                continue
+            self.pod_map.pop(name, None)
+            self.sampler.close(name)
+            actuator = self.actuators.pop(name, None)
+            if actuator is not None:
+                actuator.close()
+            self.limits[name] = None
+            self.last_counters.pop(name, None)
+            if name in self.scalers:
+                self.scalers[name].reset()
+            if pod is None:
+                print(f'pod of {self.namespace}/{name} is gone')
+                continue
+            try:
+                actuator = self.cgroup.actuator(pod)
+            except (OSError, ValueError):
+                print(f'cannot open pod {pod[1]} of {self.namespace}/{name}, will retry')
+                continue
+            try:
+                actuator.set(None)
+                self.sampler.open(name, pod)
+            except (OSError, ValueError):
+                actuator.close()
+                print(f'cannot open pod {pod[1]} of {self.namespace}/{name}, will retry')
+                continue
+            self.actuators[name] = actuator
+            self.pod_map[name] = pod
+            print(f'{self.namespace}/{name} is pod {pod[1]}')
+
+    # the sample is stamped with when it was read, which is after its deadline when a tick runs late
+    def read(self):
+        start_time = time.perf_counter()
+        self.sampler.read()
+        self.read_t = start_time
+        self.read_time = time.perf_counter() - start_time
+
+    def step(self, t, monotonic_base, lateness, late):
+        store = self.store
+        scalers = self.scalers
+        self.lateness.add(lateness)
+        if late:
+            self.late_end_time += 1
 
-        if control['update']:
-            for k, v in control['update'].items():
+        if self.pod_maps:
+            self.apply_pod_map(self.pod_maps.popleft())
+
+        start_time = time.perf_counter()
+        store.begin(t + monotonic_base)
+        stats = {}
+        for name, (usage, nr_periods, nr_throttled, throttled_time) in self.sampler.decode().items():
+            store.set(name, 'cpu_usage', usage)
+            store.set(name, 'cpu_stat.nr_periods', nr_periods)
+            store.set(name, 'cpu_stat.nr_throttled', nr_throttled)
+            store.set(name, 'cpu_stat.throttled_time', throttled_time)
+            if self.arbitrated:
+                last = self.last_counters.get(name)
+                if last is not None and nr_periods > last[0]:
+                    self.pressure[name] = 0.9 * self.pressure[name] + 0.1 * (nr_throttled - last[1]) / (nr_periods - last[0])
+                self.last_counters[name] = (nr_periods, nr_throttled)
+            # short-lived view for the scalers, it is not kept after the scaler drops it
+            stats[name] = {
+                'cpu_usage': usage / 1e9,
+                'cpu_stat.nr_periods': nr_periods,
+                'cpu_stat.nr_throttled': nr_throttled,
+                'cpu_stat.throttled_time': throttled_time / 1e9,
+            }
+        store.set(self.daemon, 'sampler.read_time', self.read_time)
+        store.set(self.daemon, 'scheduler.lateness', lateness)
+        store.set(self.daemon, 'sampler.decode_time', time.perf_counter() - start_time)
+
+        while self.updates:
+            for k, v in self.updates.popleft().items():
                 if k in scalers:
                     scalers[k].update(*v)
-            control['update'] = {}
 
+        # only the latest hint matters, it raises limits before the scalers run so the raise is applied in this tick
+        if self.hints:
+            hint = self.hints.popleft()
+            raised = {} if self.batch is None else self.batch.hint(hint['rps'], hint['predicted_rps'])
+            for name, scaler in scalers.items():
+                limit = scaler.hint(hint['rps'], hint['predicted_rps'])
+                if limit is not None:
+                    raised[name] = limit
+            for name, limit in raised.items():
+                store.set(name, 'captain.hint_limit', limit)
+
+        batch_limits = {} if self.batch is None else self.batch(t, stats)
+        self.requested = {}
         for name, scaler in scalers.items():
-            limit = scaler(t, stats[name])
+            if name not in stats:
+                continue
+            if name in batch_limits:
+                limit = batch_limits[name]
+            else:
+                limit = scaler(t, stats[name])
             if limit is not None:
                 limit = max(0.01, limit)
-                if limits[name] is not None:
-                    if abs(limit - limits[name]) < 0.00001:
-                        limit = limits[name]
+            self.requested[name] = limit
+            if 'captain.margin' in stats[name]:
+                store.set(name, 'captain.margin', stats[name]['captain.margin'])
+                store.set(name, 'captain.period', stats[name]['captain.period'])
+
+    # second half of a tick, after the node has seen the requested limits of all sessions
+    # granted is self.requested, or what the node's Arbiter granted of it
+    def apply(self, granted):
+        store = self.store
+        limits = self.limits
+        # the scalers go on from the limits they got rather than from the ones they asked for
+        if self.arbitrated:
+            for name, limit in granted.items():
+                if limit is not None and limit != self.requested[name]:
+                    self.scalers[name].grant(limit)
+        changes = {}
+        for name, limit in granted.items():
+            if limit is not None and limits[name] is not None:
+                if abs(limit - limits[name]) < 0.00001:
+                    limit = limits[name]
             if limit != limits[name]:
+                changes[name] = limit
+
+        # all changes of this tick are written together, after every scaler has run
+        if changes:
+            start_time = time.perf_counter()
+            for name, limit in changes.items():
+                try:
+                    self.actuators[name].set(limit)
+                except OSError as e:
+                    # most likely the pod is gone, discovery will pick up its replacement
+                    print(f'cannot set limit of {self.namespace}/{name}: {e}')
+                    continue
                 limits[name] = limit
-                set_cpu_limit(pod_map, name, limit)
-            stats[name]['scaler.limit'] = limits[name]
-
-        for name in stats:
-            stats_history[name].append((t + monotonic_base, stats[name]))
-            stats_current[name].append((t + monotonic_base, stats[name]))
-
-    if late_end_time:
-        print(f'late end time: {late_end_time}')
-
-    for f in files.values():
-        f.close()
-
-
-def process_client(client_socket):
-    line = client_socket.readline()
-    data = json.loads(line)
-    assert data['method'] == 'start'
-    control = {
-        'stop': False,
-        'socket': client_socket,
-        'update': {},
-    }
-    scalers = {k: init_scaler(v) for k, v in data['scalers'].items()}
-    thread = threading.Thread(target=run, args=(control, data['namespace'], data['components'], scalers))
-    thread.start()
-    client_socket.write(json.dumps({'ok': True}) + '\n')
-    client_socket.flush()
+            store.set(self.daemon, 'actuator.time', time.perf_counter() - start_time)
+            store.set(self.daemon, 'actuator.count', len(changes))
+
+        for name in self.components:
+            if limits[name] is not None:
+                store.set(name, 'scaler.limit', limits[name])
+        if self.arbitrated:
+            for name, limit in self.requested.items():
+                if limit is not None:
+                    store.set(name, 'scaler.requested', limit)
+
+        store.commit()
+
+    def close(self):
+        if self.late_end_time:
+            print(f'late end time: {self.late_end_time}')
+        if self.store.length:
+            read_time = self.store.read_column(self.daemon, 'sampler.read_time')
+            print(f'sampler read time: mean {statistics.mean(read_time) * 1e3:.3f} ms, max {max(read_time) * 1e3:.3f} ms')
+            print(f'tick lateness: mean {self.lateness.sum / self.lateness.count * 1e3:.3f} ms, max {self.lateness.max * 1e3:.3f} ms')
+            actuator_time = [i for i in self.store.read_column(self.daemon, 'actuator.time') if not math.isnan(i)]
+            if actuator_time:
+                print(f'actuator time: mean {statistics.mean(actuator_time) * 1e3:.3f} ms, max {max(actuator_time) * 1e3:.3f} ms')
+        self.sampler.close()
+        for actuator in self.actuators.values():
+            actuator.close()
+        self.closed = True
+
+
+class Node:
+    # the single sampling thread of this node, shared by all sessions
+    # ticks start read_slack before each period boundary, so that reads finish around the boundary
+    discovery_interval = 5
+    read_slack = 0.003
+
+    def __init__(self, period=0.1, policy='skip', budget=None):
+        self.ticker = Ticker(period, offset=-self.read_slack, policy=policy)
+        self.arbiter = None if budget is None else Arbiter(budget)
+        self.cgroup = detect_cgroup()
+        self.discovery = PodDiscovery(self.cgroup)
+        self.sessions = ()
+        self.lock = threading.Lock()
+        self.claimed = set()
+        self.ids = itertools.count(1)
+        self.by_id = {}
+
+    # a pod can only be controlled by one session at a time
+    def claim(self, namespace, components):
+        claimed = {(namespace, i) for i in components}
+        if claimed & self.claimed:
+            raise ValueError(f'already controlled by another session: {sorted(claimed & self.claimed)}')
+        self.claimed |= claimed
+
+    def release(self, namespace, components):
+        self.claimed -= {(namespace, i) for i in components}
+
+    def add(self, session):
+        session.id = f'{session.namespace}-{next(self.ids)}'
+        self.by_id[session.id] = session
+        with self.lock:
+            self.sessions += (session,)
+
+    # blocks until the sampling thread no longer touches the session
+    def remove(self, session):
+        self.by_id.pop(session.id, None)
+        with self.lock:
+            self.sessions = tuple(i for i in self.sessions if i is not session)
+
+    # diffs the pods of every session against the node's current pods, changes are applied by the sampling thread
+    def discover(self):
+        scan = self.discovery.scan()
+        for session in self.sessions:
+            pod_map = self.discovery.pod_map(scan, session.namespace, session.components, session.pod_map)
+            if pod_map != session.pod_map:
+                session.pod_maps.append(pod_map)
+
+    # drops a session whose step raised, the error is reported to its controller
+    def fail(self, session):
+        traceback.print_exc()
+        session.error = traceback.format_exc()
+        self.sessions = tuple(i for i in self.sessions if i is not session)
+
+    def run(self):
+        monotonic_base = time.time() - time.perf_counter()
+        while True:
+            t = self.ticker.wait()
+
+            with self.lock:
+                sessions = self.sessions
+                for session in sessions:
+                    session.read()
+                end_time = time.perf_counter()
+                late = end_time > t + self.read_slack
+                stepped = []
+                for session in sessions:
+                    try:
+                        session.step(session.read_t, monotonic_base, self.ticker.last_lateness, late)
+                        stepped.append(session)
+                    except Exception:
+                        self.fail(session)
+                if self.arbiter is not None:
+                    granted = self.arbiter({
+                        (session, name): (limit, session.priorities[name] * (1 + session.pressure[name]))
+                        for session in stepped
+                        for name, limit in session.requested.items()
+                    })
+                for session in stepped:
+                    try:
+                        if self.arbiter is None:
+                            session.apply(session.requested)
+                        else:
+                            session.store.set(session.daemon, 'arbiter.requested', self.arbiter.requested)
+                            session.store.set(session.daemon, 'arbiter.granted', self.arbiter.granted)
+                            session.apply({name: granted[session, name] for name in session.requested})
+                    except Exception:
+                        self.fail(session)
+                work_time = time.perf_counter() - self.ticker.woke
+                for session in sessions:
+                    session.work_time.add(work_time)
+
+
+def encode(data):
+    return json.dumps(data).encode() + b'\n'
+
+
+def stats_reply(encoding, store, start=0, stop=None, **kwargs):
+    if encoding == 'json':
+        yield encode({
+            'ok': True,
+            'stats': store.read(start, stop),
+            **kwargs,
+        })
+        return
+    yield encode({'ok': True, 'encoding': encoding, **kwargs})
+    for header, payload in store.frames(start, stop):
+        yield encode(header) + payload
+    yield encode({'end': True})
+
+
+# writes a stats reply chunk by chunk, each chunk is read and encoded in the executor while the loop serves others,
+# and written before the next one is made, so only one chunk of a run is in memory at a time
+async def write_stats_reply(writer, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    chunks = stats_reply(*args, **kwargs)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        writer.write(chunk)
+        await writer.drain()
+
+
+async def process_client(node, reader, writer):
+    loop = asyncio.get_running_loop()
+    print(f'accepted connection from {writer.get_extra_info("peername")}')
+    session = None
     try:
+        line = await reader.readline()
+        data = json.loads(line)
+        if data['method'] == 'subscribe':
+            await process_subscriber(node, writer, data)
+            return
+        assert data['method'] == 'start'
+        encoding = data.get('encoding', 'json')
+        assert encoding in ('json', 'binary')
+        scalers = {k: init_scaler(v, node.ticker.period) for k, v in data['scalers'].items()}
+        node.claim(data['namespace'], data['components'])
+        try:
+            session = await loop.run_in_executor(
+                None, Session, node, data['namespace'], data['components'], scalers, encoding,
+                data.get('batch', False), data.get('priorities', {}),
+            )
+        except Exception:
+            node.release(data['namespace'], data['components'])
+            raise
+        node.add(session)
+        writer.write(encode({'ok': True, 'encoding': encoding, 'session': session.id}))
+        await writer.drain()
         while True:
-            line = client_socket.readline()
+            line = await reader.readline()
             data = json.loads(line)
+            if session.error is not None:
+                raise RuntimeError(f'session failed:\n{session.error}')
             if data['method'] == 'update':
-                control['update'] = data['update']
-                client_socket.write(json.dumps({'ok': True}) + '\n')
-                client_socket.flush()
+                session.updates.append(data['update'])
+                writer.write(encode({'ok': True}))
+                await writer.drain()
+                continue
+            elif data['method'] == 'hint':
+                session.hints.append(data['hint'])
+                writer.write(encode({'ok': True}))
+                await writer.drain()
                 continue
             elif data['method'] == 'stats':
-                stats = {}
-                for i in control['stats_current']:
-                    stats[i] = control['stats_current'][i]
-                    control['stats_current'][i] = []
-                client_socket.write(json.dumps({
-                    'ok': True,
-                    'stats': stats,
-                }) + '\n')
-                client_socket.flush()
+                length = session.store.length
+                await write_stats_reply(writer, encoding, session.store, session.cursor, length)
+                session.cursor = length
                 continue
             elif data['method'] == 'stop':
-                control['stop'] = True
-                thread.join()
-                client_socket.write(json.dumps({
-                    'ok': True,
-                    'stats': control['stats'],
-                }) + '\n')
-                client_socket.flush()
-                client_socket.close()
+                await loop.run_in_executor(None, node.remove, session)
+                session.close()
+                node.release(session.namespace, session.components)
+                scheduler = {
+                    'period': node.ticker.period,
+                    'policy': node.ticker.policy,
+                    'lateness': session.lateness.to_dict(),
+                    'work_time': session.work_time.to_dict(),
+                }
+                await write_stats_reply(writer, encoding, session.store, scheduler=scheduler)
+                writer.close()
+                print('finished')
                 break
             raise ValueError(f'unknown method: {data["method"]}')
-    except Exception:
+    except Exception as e:
         traceback.print_exc()
-        control['stop'] = True
-        thread.join()
-        client_socket.close()
-        print('thread stopped')
+        writer.write(encode({'ok': False, 'error': repr(e)}))
+        if session is not None:
+            await loop.run_in_executor(None, node.remove, session)
+            session.close()
+            node.release(session.namespace, session.components)
+        writer.close()
+        print('session stopped')
         print()
 
 
-def main():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 12198))
-    server_socket.listen()
-    print('listening')
+# pushes the samples of a session every interval until the session stops
+# every push is a stats reply with 'event': 'stats', the last message is {'ok': True, 'event': 'stopped'}
+async def process_subscriber(node, writer, data):
+    session = node.by_id[data['session']]
+    encoding = data.get('encoding', 'json')
+    assert encoding in ('json', 'binary')
+    interval = data.get('interval', 1)
+    assert interval > 0
+    cursor = session.store.length
+    writer.write(encode({'ok': True, 'encoding': encoding}))
+    await writer.drain()
     while True:
-        client_socket, address = server_socket.accept()
-        print(f'accepted connection from {address}')
-        process_client(client_socket.makefile('rw'))
-        print('finished')
+        await asyncio.sleep(interval)
+        closed = session.closed
+        length = session.store.length
+        if length > cursor:
+            await write_stats_reply(writer, encoding, session.store, cursor, length, event='stats')
+            cursor = length
+        if closed or session.error is not None:
+            break
+    writer.write(encode({'ok': True, 'event': 'stopped'}))
+    await writer.drain()
+    writer.close()
+    print(f'subscriber of {session.id} finished')
+
+
+async def discover(node):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(node.discovery_interval)
+        try:
+            await loop.run_in_executor(None, node.discover)
+        except Exception:
+            traceback.print_exc()
+
+
+async def serve(node):
+    asyncio.get_running_loop().create_task(discover(node))
+    server = await asyncio.start_server(functools.partial(process_client, node), '0.0.0.0', 12198, limit=1 << 24)
+    print('listening')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--period', type=float, default=0.1, help='sampling and control period in seconds')
+    parser.add_argument('--policy', choices=['skip', 'catch-up'], default='skip', help='what to do with ticks missed by overruns')
+    parser.add_argument('--budget', type=float, help='CPU cores shared by the limits of all sessions, unlimited by default')
+    args = parser.parse_args()
+
+    node = Node(args.period, args.policy, args.budget)
+    threading.Thread(target=node.run, daemon=True).start()
+    asyncio.run(serve(node))
 
 
 if __name__ == '__main__':